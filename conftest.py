@@ -0,0 +1,31 @@
+# Copyright 2018, 2019, 2020 Andrzej Cichocki
+
+# This file is part of lagoon.
+#
+# lagoon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lagoon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
+
+from tempfile import TemporaryDirectory
+import os
+
+def pytest_configure(config):
+    'Keep the real PATH index cache out of it, including that of any child that imports lagoon.'
+    global cachehome, environ
+    cachehome = TemporaryDirectory()
+    environ = os.environ.copy()
+    os.environ['XDG_CACHE_HOME'] = cachehome.name
+
+def pytest_unconfigure(config):
+    os.environ.clear()
+    os.environ.update(environ)
+    cachehome.cleanup()
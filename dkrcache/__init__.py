@@ -23,39 +23,14 @@ from functools import partial
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from lagoon.binary import docker, tar
-from lagoon.util import mapcm
+from lagoon.util import ABRUPT, AbruptOutcome, ALWAYS, mapcm, NEVER, NORMAL, NormalOutcome
 from pathlib import Path
 from pkg_resources import resource_string
 from tempfile import TemporaryDirectory
 import logging, os, pickle, re, time
 
+__all__ = ['ABRUPT', 'AbruptOutcome', 'ALWAYS', 'ExpensiveTask', 'MissHandler', 'NEVER', 'NORMAL', 'NormalOutcome', 'SaveHandler'] # The outcome names are re-exported from lagoon.util.
 log = logging.getLogger(__name__)
-NORMAL = lambda o: o.exception() is None
-ABRUPT = lambda o: o.exception() is not None
-ALWAYS = lambda o: True
-NEVER = lambda o: False
-
-class NormalOutcome:
-
-    def __init__(self, obj):
-        self.obj = obj
-
-    def result(self):
-        return self.obj
-
-    def exception(self):
-        pass
-
-class AbruptOutcome:
-
-    def __init__(self, e):
-        self.e = e
-
-    def result(self):
-        raise self.e
-
-    def exception(self):
-        return self.e
 
 class MissHandler(BaseHTTPRequestHandler):
 
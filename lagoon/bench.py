@@ -0,0 +1,265 @@
+# Copyright 2018, 2019, 2020 Andrzej Cichocki
+
+# This file is part of lagoon.
+#
+# lagoon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lagoon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Rough benchmarks, run with: python -m lagoon.bench
+All results are seconds except where the name says bytes, so for every result lower is better.
+Use --json to save results and --compare to show the ratio against a previous run.'''
+from .builtins import builtinpopen
+from .program import _returncodecheck, bg, forkserver, NOEOL, partial, ProcessGroup, Program, spawn, tee
+from .util import PYTHONPATH, transfer
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory, TemporaryFile
+import json, os, platform, shutil, subprocess, sys, time, tracemalloc
+
+eagerscan = '''from lagoon.program import PathIndex, Program
+import os
+for name, parent in PathIndex(os.environ['PATH'].split(os.pathsep))._allprograms().items():
+    path = os.path.join(parent, name)
+    Program.text(path), Program.binary(path)
+'''
+
+def _besttime(f, repeat):
+    def times():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            f()
+            yield time.perf_counter() - start
+    return min(times())
+
+def importtime(entries = 5000, repeat = 10):
+    '''Interpreter startup plus import and resolution of a few programs and an alias, with many dummy entries on PATH.
+    Compare bare against baseline for the cost of the import alone, which should be less than that of eagerly scanning PATH.
+    The alias needs a listing of PATH, which cold does from scratch and warm loads from the cache.'''
+    with TemporaryDirectory() as d, TemporaryDirectory() as cachehome:
+        for i in range(entries):
+            Path(d, f"dummy-{i}").touch()
+        t = time.time() - 60 # Old enough for the index to be persisted.
+        os.utime(d, (t, t))
+        env = dict(os.environ, PATH = os.pathsep.join([d, os.environ['PATH']]), PYTHONPATH = PYTHONPATH, XDG_CACHE_HOME = cachehome)
+        def run(code):
+            subprocess.run([sys.executable, '-c', code], env = env, check = True)
+        def python(code):
+            return _besttime(lambda: run(code), repeat)
+        lazy = 'import lagoon\nfrom lagoon import dummy_0, echo, env, true'
+        results = dict(
+            baseline = python('pass'),
+            bare = python('import lagoon'),
+            eager = python(f"import lagoon\n{eagerscan}"),
+            cold = python(f"import shutil\nshutil.rmtree({cachehome!r}, ignore_errors = True)\n{lazy}"),
+        )
+        run(lazy) # Populate the cache.
+        assert Path(cachehome, 'lagoon', 'pathindex').exists()
+        results['warm'] = python(lazy)
+        return results
+
+def spawnlatency(heapmibs = [0, 256, 1024], repeat = 50):
+    '''Time to run true with a heap of the given size in this process.
+    The fork variant uses a preexec_fn to force a real fork, which is what the other variants avoid.
+    The forkserver variant should not depend on the heap size at all.'''
+    true = Program.binary(shutil.which('true'))[print]
+    results = {}
+    for mib in heapmibs:
+        heap = bytearray(mib << 20)
+        heap[::4096] = b'\1' * len(range(0, len(heap), 4096)) # Touch every page.
+        for name, program in [['default', true], ['spawn', true[spawn]], ['fork', true[partial](preexec_fn = lambda: None)], ['forkserver', true[forkserver]]]:
+            results[f"{name}.{mib}MiB"] = _besttime(program, repeat)
+        del heap
+    return results
+
+def calloverhead(repeat = 2000):
+    '''Per-call cost of lagoon compared to raw subprocess.run, with and without actually launching a process.
+    Passing a kwarg forces the uncached transform.'''
+    path = shutil.which('true')
+    true = Program.text(path)[partial]('--flag')
+    def transform():
+        true._transform(('arg',), {}, _returncodecheck)
+    def transformuncached():
+        true._transform(('arg',), dict(stderr = None), _returncodecheck)
+    trueenv = true[partial](env = dict(BENCH = 'x'))
+    def transformenv():
+        trueenv._transform(('arg',), {}, _returncodecheck)
+    def transformenvuncached():
+        true._transform(('arg',), dict(env = dict(BENCH = 'x')), _returncodecheck)
+    return dict(
+        transform = _besttime(transform, repeat),
+        transformuncached = _besttime(transformuncached, repeat),
+        transformenv = _besttime(transformenv, repeat),
+        transformenvuncached = _besttime(transformenvuncached, repeat),
+        subprocess = _besttime(lambda: subprocess.run([path, '--flag', 'arg'], stdout = subprocess.PIPE, check = True, universal_newlines = True), repeat // 10),
+        lagoon = _besttime(lambda: true('arg'), repeat // 10),
+    )
+
+def programmemory(count = 50000, repeat = 10000):
+    '''Bytes held per partially applied program, and cost of a repeated attribute chain.
+    The net bytes allocated by the chains after the first should be about zero as the results are interned.'''
+    docker = Program.binary('/usr/bin/docker')
+    tracemalloc.start()
+    try:
+        partials = [docker.__host[partial](f"host{i}") for i in range(count)]
+        held, _ = tracemalloc.get_traced_memory()
+        del partials
+        docker.build.__network.host.__quiet[print] # Intern it.
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(repeat):
+            docker.build.__network.host.__quiet[print]
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(
+        bytesperpartial = held / count,
+        chainnetbytes = end - start,
+        chainseconds = _besttime(lambda: docker.build.__network.host.__quiet[print], repeat),
+    )
+
+def modeoverhead(repeat = 200):
+    '''Wall time per call of each mode with a trivial child, against raw subprocess.run.
+    The deep variant has a chain of 50 partials, which should cost no more than one.'''
+    echopath = shutil.which('echo')
+    echo = Program.text(echopath)
+    deep = echo
+    for i in range(50):
+        deep = deep[partial](f"arg{i}")
+    def bgmode():
+        with echo[bg]('woo') as stdout:
+            stdout.read()
+    return dict(
+        subprocess = _besttime(lambda: subprocess.run([echopath, 'woo'], stdout = subprocess.PIPE, check = True, universal_newlines = True), repeat),
+        fg = _besttime(lambda: echo('woo'), repeat),
+        bg = _besttime(bgmode, repeat),
+        tee = _besttime(lambda: echo[tee(StringIO())]('woo'), repeat),
+        json = _besttime(lambda: echo[json]('[]'), repeat),
+        noeol = _besttime(lambda: echo[NOEOL]('woo'), repeat),
+        deep = _besttime(lambda: deep('woo'), repeat),
+    )
+
+def throughput(mibs = 256, repeat = 3):
+    'Time to capture a large stdout in text and binary mode, against raw subprocess.run.'
+    cmd = [shutil.which('head'), '-c', str(mibs << 20), '/dev/zero']
+    head = Program.text(cmd[0])._c[partial](*cmd[2:])
+    return {
+        f"subprocess.{mibs}MiB": _besttime(lambda: subprocess.run(cmd, stdout = subprocess.PIPE, check = True), repeat),
+        f"binary.{mibs}MiB": _besttime(lambda: head[partial](universal_newlines = False)(), repeat),
+        f"text.{mibs}MiB": _besttime(head, repeat),
+        f"tee.{mibs}MiB": _besttime(lambda: head[tee(lambda _: None, tailsize = 0)](), repeat),
+    }
+
+def fanout(counts = [1, 10, 100], repeat = 5):
+    'Wall time to run many sleeps concurrently via bg, via fg on a thread pool, and via a ProcessGroup.'
+    sleep = Program.text(shutil.which('sleep'))[partial](.1, stdout = subprocess.DEVNULL)
+    results = {}
+    for n in counts:
+        def bgfanout():
+            with ExitStack() as stack:
+                for _ in range(n):
+                    stack.enter_context(sleep[bg]())
+        def poolfanout():
+            with ThreadPoolExecutor(n) as e:
+                for f in [e.submit(sleep) for _ in range(n)]:
+                    f.result()
+        def groupfanout():
+            with ProcessGroup() as group:
+                for _ in range(n):
+                    group.add(sleep)
+                group.run()
+        results[f"bg.{n}"] = _besttime(bgfanout, repeat)
+        results[f"pool.{n}"] = _besttime(poolfanout, repeat)
+        results[f"group.{n}"] = _besttime(groupfanout, repeat)
+    return results
+
+def builtinlatency(repeat = 500):
+    'Wall time per call of trivial commands run for real against their in-process builtins.'
+    results = {}
+    for name, args in [['true', []], ['echo', ['woo']], ['basename', ['/a/b.txt', '.txt']]]:
+        program = Program.text(shutil.which(name))
+        results[f"real.{name}"] = _besttime(lambda: program(*args), repeat)
+        builtin = program[partial](popen = builtinpopen)
+        results[f"builtin.{name}"] = _besttime(lambda: builtin(*args), repeat)
+    return results
+
+def zerocopy(gibs = [1, 4], repeat = 3):
+    '''Time to pipe a large file into a child and to save a child's stdout, via transfer against a buffered copy through Python.
+    The input file is sparse so that disk speed doesn't dominate, and the output goes to /dev/null.'''
+    cat = Program.binary(shutil.which('cat'))
+    head = Program.binary(shutil.which('head'))
+    def buffered(src, dst, size):
+        while size:
+            chunk = src.read(min(size, 0x10000))
+            if not chunk:
+                break
+            dst.write(chunk)
+            size -= len(chunk)
+    results = {}
+    with TemporaryFile() as f, open(os.devnull, 'wb') as null:
+        for gib in gibs:
+            size = gib << 30
+            f.truncate(size)
+            def tochild(copy):
+                def run():
+                    f.seek(0)
+                    with cat[bg](stdin = subprocess.PIPE, stdout = subprocess.DEVNULL) as stdin:
+                        with stdin:
+                            copy(f, stdin, size)
+                return run
+            def fromchild(copy):
+                def run():
+                    with head[bg]('-c', size, '/dev/zero') as stdout:
+                        copy(stdout, null, size)
+                return run
+            for name, copy in [['transfer', transfer], ['buffered', buffered]]:
+                results[f"tochild.{name}.{gib}GiB"] = _besttime(tochild(copy), repeat)
+                results[f"fromchild.{name}.{gib}GiB"] = _besttime(fromchild(copy), repeat)
+    return results
+
+benchmarks = [importtime, spawnlatency, calloverhead, modeoverhead, throughput, fanout, programmemory, builtinlatency, zerocopy]
+
+def _compare(results, baseline, threshold):
+    for name, value in results.items():
+        try:
+            old = baseline[name]
+        except KeyError:
+            continue
+        ratio = value / old if old else float('inf') if value else 1
+        print(f"{name}: {old:.6g} -> {value:.6g} ({ratio:.2f}x){' REGRESSION' if ratio > threshold else ''}")
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--json', help = 'write results to this file')
+    parser.add_argument('--compare', help = 'show ratios against results previously written with --json')
+    parser.add_argument('--threshold', type = float, default = 1.2, help = 'ratio above which a result is flagged as a regression')
+    parser.add_argument('names', nargs = '*', help = 'benchmarks to run, default all of: %s' % ' '.join(b.__name__ for b in benchmarks))
+    config = parser.parse_args()
+    selected = [b for b in benchmarks if not config.names or b.__name__ in config.names]
+    results = {}
+    for benchmark in selected:
+        for name, value in benchmark().items():
+            name = f"{benchmark.__name__}.{name}"
+            print(f"{name}: {value:.6g}", flush = True)
+            results[name] = value
+    if config.json is not None:
+        with open(config.json, 'w') as f:
+            json.dump(dict(python = sys.version, platform = platform.platform(), results = results), f, indent = 4)
+    if config.compare is not None:
+        with open(config.compare) as f:
+            _compare(results, json.load(f)['results'], config.threshold)
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,115 @@
+# Copyright 2018, 2019, 2020 Andrzej Cichocki
+
+# This file is part of lagoon.
+#
+# lagoon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lagoon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
+
+'''In-process implementations of trivial commands, with the same stdout and exit code as the coreutils ones.
+Each implementation is a function of the args that returns None if it doesn't support them, in which case the real program runs.'''
+from . import program
+from .program import _readall, InProcessPopen, refresh
+import functools, os, re, subprocess
+
+echooptions = re.compile('-[neE]+')
+
+def _true(args):
+    if args not in (['--help'], ['--version']):
+        return lambda cwd, input: (0, b'', b'')
+
+def _false(args):
+    if args not in (['--help'], ['--version']):
+        return lambda cwd, input: (1, b'', b'')
+
+def _echo(args):
+    if args in (['--help'], ['--version']):
+        return
+    newline = b'\n'
+    while args and echooptions.fullmatch(args[0]):
+        if 'e' in args[0]:
+            return # Escapes not supported.
+        if 'n' in args[0]:
+            newline = b''
+        args = args[1:]
+    return lambda cwd, input: (0, b' '.join(map(os.fsencode, args)) + newline, b'')
+
+def _cat(args):
+    if any(a.startswith('-') and a != '-' for a in args):
+        return
+    def cat(cwd, input):
+        stdout = []
+        stderr = []
+        for name in args or ['-']:
+            if '-' == name:
+                stdout.append(_readall(0) if input is None else input)
+                input = b''
+                continue
+            try:
+                with open(os.path.join(cwd, name), 'rb') as f:
+                    stdout.append(f.read())
+            except OSError as e:
+                stderr.append(f"cat: {name}: {e.strerror}\n".encode())
+        return int(bool(stderr)), b''.join(stdout), b''.join(stderr)
+    return cat
+
+def _pwd(args):
+    if not args:
+        return lambda cwd, input: (0, os.fsencode(os.path.realpath(cwd)) + b'\n', b'')
+
+def _basename(args):
+    if not (1 <= len(args) <= 2) or any(a.startswith('-') for a in args):
+        return
+    def basename(cwd, input):
+        name = args[0].rstrip('/')
+        if not name:
+            name = args[0][:1] # Either / or empty.
+        else:
+            name = name.rsplit('/', 1)[-1]
+            if len(args) > 1 and args[1] and name != args[1] and name.endswith(args[1]):
+                name = name[:-len(args[1])]
+        return 0, os.fsencode(name) + b'\n', b''
+    return basename
+
+registry = dict(basename = _basename, cat = _cat, echo = _echo, false = _false, pwd = _pwd, true = _true)
+
+def _outcome(impl, args, cwd, env, input, merged, kwargs):
+    return impl(os.getcwd() if cwd is None else os.fsdecode(cwd), input)
+
+def builtinpopen(args, **kwargs):
+    'Popen factory that runs the implementation for the basename of args[0] in-process, or the real program if none supports the args.'
+    return _builtinpopen(subprocess.Popen, args, **kwargs)
+
+def _builtinpopen(fallback, args, **kwargs):
+    f = registry.get(os.path.basename(os.fsdecode(args[0])))
+    impl = None if f is None else f([os.fsdecode(a) for a in args[1:]])
+    return fallback(args, **kwargs) if impl is None else InProcessPopen(functools.partial(_outcome, impl), args, **kwargs)
+
+def _fallback(popen):
+    return popen.args[0] if isinstance(popen, functools.partial) and popen.func is _builtinpopen else popen
+
+def enable(*names):
+    '''Make scan bind the given programs (default all in the registry) to builtinpopen, via refresh so programs already imported by name are unaffected.
+    Args no implementation supports go to the popen scan would otherwise have bound.'''
+    for name in names or registry:
+        program.inprocess[name] = functools.partial(_builtinpopen, _fallback(program.inprocess.get(name, subprocess.Popen)))
+    refresh()
+
+def disable():
+    'Undo enable, restoring any popen that it captured.'
+    for name, popen in list(program.inprocess.items()):
+        popen = _fallback(popen)
+        if popen is subprocess.Popen:
+            del program.inprocess[name]
+        else:
+            program.inprocess[name] = popen
+    refresh()
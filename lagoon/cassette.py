@@ -0,0 +1,161 @@
+# Copyright 2018, 2019, 2020 Andrzej Cichocki
+
+# This file is part of lagoon.
+#
+# lagoon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lagoon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Record and replay of every process launched via lagoon, so that test suites can run without spawning anything.
+This works at the popen level, so all styles behave the same in both modes, except asyncio and exec which don't use it.
+Interactive use, where stdin depends on output already read, can be recorded but not replayed.'''
+from .program import _writeall, backends, chunksize, InProcessPopen
+from .util import atomic
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock, Thread
+import functools, hashlib, json, os, subprocess
+
+streamkeys = {'bufsize', 'encoding', 'errors', 'stderr', 'stdin', 'stdout', 'text', 'universal_newlines'}
+
+class UnmatchedInvocation(Exception): pass
+
+class Invocation:
+
+    def __init__(self, argv, cwd, env, stdin):
+        self.argv = argv
+        self.cwd = cwd
+        self.env = env
+        self.stdin = stdin
+
+    @classmethod
+    def of(cls, args, cwd, env, input):
+        '''The env is reduced to its differences from os.environ, where None means deleted.
+        Stdin is a digest of the input, or None if stdin was inherited.'''
+        return cls([os.fsdecode(a) for a in args], None if cwd is None else os.fsdecode(cwd),
+                {} if env is None else {**{k: None for k in os.environ if k not in env}, **{k: v for k, v in env.items() if os.environ.get(k) != v}},
+                None if input is None else hashlib.sha256(input).hexdigest())
+
+    def key(self):
+        return tuple(self.argv), self.cwd, frozenset(self.env.items()), self.stdin
+
+    def __str__(self):
+        return f"argv={self.argv} cwd={self.cwd} env={self.env} stdin={self.stdin}"
+
+class RecordingPopen(InProcessPopen):
+    '''Launch the real process via the given popen and stand in for it, streaming each std fd through so that the outcome can be recorded when it exits.
+    Signals are forwarded to the real process. The recorded stdin is what the process consumed.'''
+
+    def __init__(self, popen, record, args, **kwargs):
+        self.popen = popen
+        self.record = record
+        super().__init__(None, args, **kwargs)
+
+    def _launch(self, a, fds, merged):
+        real = self.real = self.popen(a['args'], stdin = None if fds[0] is None else subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT if merged else subprocess.PIPE,
+                **{k: v for k, v in self.kwargs.items() if k not in streamkeys})
+        stdinfd, fds[0] = fds[0], None # The feeder owns it, as it may still be reading when the process exits.
+        input = None if stdinfd is None else bytearray()
+        def feed():
+            try:
+                with real.stdin:
+                    for chunk in iter(functools.partial(os.read, stdinfd, chunksize), b''):
+                        input.extend(chunk)
+                        _writeall(real.stdin.fileno(), chunk)
+            except BrokenPipeError:
+                pass
+            finally:
+                os.close(stdinfd)
+        def pump(source, fd, chunks):
+            with source:
+                for chunk in iter(functools.partial(os.read, source.fileno(), chunksize), b''):
+                    chunks.append(chunk)
+                    try:
+                        _writeall(fd, chunk)
+                    except BrokenPipeError:
+                        break # Closing the source then has the same effect on the process.
+        def child():
+            stdout, stderr = [], []
+            threads = [] if merged else [Thread(target = pump, args = (real.stderr, fds[2], stderr))]
+            for t in threads:
+                t.start()
+            pump(real.stdout, fds[1], stdout)
+            for t in threads:
+                t.join()
+            returncode = real.wait()
+            self.record(a['args'], a['cwd'], a['env'], None if input is None else bytes(input), returncode, b''.join(stdout), b''.join(stderr))
+            return returncode
+        if stdinfd is not None:
+            Thread(target = feed, daemon = True).start()
+        return child
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            self.real.send_signal(sig)
+
+class Cassette:
+    '''Fixture file of recorded invocations, one JSON object per line.
+    Within record, every process is actually run, and the outcomes are saved on exit.
+    Within replay, outcomes are served in recorded order per invocation, repeating the last, and anything not recorded raises UnmatchedInvocation from the wait.'''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = Lock()
+
+    @staticmethod
+    def _decode(data):
+        return data.decode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def _encode(text):
+        return text.encode('utf-8', 'surrogateescape')
+
+    @contextmanager
+    def _install(self, backend):
+        backends.append(backend)
+        try:
+            yield self
+        finally:
+            backends.remove(backend)
+
+    @contextmanager
+    def record(self):
+        entries = []
+        def record(args, cwd, env, input, returncode, stdout, stderr):
+            invocation = Invocation.of(args, cwd, env, input)
+            with self.lock:
+                entries.append(dict(vars(invocation), returncode = returncode, stdout = self._decode(stdout), stderr = self._decode(stderr)))
+        with self._install(lambda popen: functools.partial(RecordingPopen, popen, record)):
+            yield self
+        with atomic(self.path) as q, q.open('w') as f:
+            for entry in entries:
+                print(json.dumps(entry), file = f)
+
+    @contextmanager
+    def replay(self):
+        index = defaultdict(deque)
+        with self.path.open() as f:
+            for line in f:
+                entry = json.loads(line)
+                invocation = Invocation(entry['argv'], entry['cwd'], entry['env'], entry['stdin'])
+                index[invocation.key()].append((entry['returncode'], self._encode(entry['stdout']), self._encode(entry['stderr'])))
+        def outcome(args, cwd, env, input, merged, kwargs):
+            invocation = Invocation.of(args, cwd, env, input)
+            with self.lock:
+                outcomes = index.get(invocation.key())
+                if outcomes is None:
+                    similar = sum(1 for k in index if k[0] == tuple(invocation.argv))
+                    raise UnmatchedInvocation(f"No recording of: {invocation}" + (f" (there are {similar} with the same argv but different cwd, env or stdin)" if similar else ''))
+                return outcomes.popleft() if len(outcomes) > 1 else outcomes[0]
+        with self._install(lambda popen: functools.partial(InProcessPopen, outcome)):
+            yield self
@@ -0,0 +1,154 @@
+# Copyright 2018, 2019, 2020 Andrzej Cichocki
+
+# This file is part of lagoon.
+#
+# lagoon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lagoon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Launch children from a small helper process, so that this process never forks.
+The helper is started on first use and exits when this process does.'''
+from .util import executechild, PYTHONPATH, waitstatus
+from threading import Lock, Thread
+import os, pickle, select, socket, subprocess, sys
+
+defaults = dict(gid = None, gids = None, uid = None, umask = -1, process_group = -1)
+supported = (3, 8) <= sys.version_info[:2] <= (3, 13) # Versions whose private Popen API is overridden correctly here.
+lock = Lock()
+control = None
+
+def _sendobj(sock, obj):
+    data = pickle.dumps(obj)
+    sock.sendall(len(data).to_bytes(8, 'big') + data)
+
+def _recvexactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+def _recvobj(sock):
+    return pickle.loads(_recvexactly(sock, int.from_bytes(_recvexactly(sock, 8), 'big')))
+
+def _helperenv():
+    'Environment of the helper, which must be able to import lagoon whatever PYTHONPATH the caller has.'
+    pythonpath = os.environ.get('PYTHONPATH')
+    return dict(os.environ, PYTHONPATH = PYTHONPATH if not pythonpath else os.pathsep.join([PYTHONPATH, pythonpath]))
+
+def _control():
+    global control
+    with lock:
+        if control is None:
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            with child:
+                subprocess.Popen([sys.executable, '-c', f"from lagoon.forkserver import main; main({child.fileno()})"],
+                        stdin = subprocess.DEVNULL, pass_fds = [child.fileno()], env = _helperenv())
+            control = parent
+        return control
+
+class ForkServerPopen(subprocess.Popen):
+    '''Popen that has the helper launch the child via its own Popen, passing the std fds over a unix socket and waiting for the exit status over another.
+    Signals also go via the helper, as only it knows whether the child has been reaped and its pid may be reused.
+    Falls back to launching directly if a kwarg can't be forwarded, such as preexec_fn or pass_fds.'''
+
+    conn = None
+
+    def _execute_child(self, *args, **kwargs):
+        a = executechild().bind(self, *args, **kwargs).arguments
+        if a['shell'] or a['preexec_fn'] is not None or a['pass_fds'] or not a['close_fds'] or any(a.get(k, v) != v for k, v in defaults.items()):
+            return super()._execute_child(*args, **kwargs)
+        stdfds = [i if fd == -1 else fd for i, fd in enumerate([a['p2cread'], a['c2pwrite'], a['errwrite']])]
+        env = a['env']
+        conn, serverconn = socket.socketpair()
+        try:
+            with serverconn:
+                socket.send_fds(_control(), [b'\0'], [serverconn.fileno(), *stdfds])
+            _sendobj(conn, [a['args'], a['executable'], os.getcwd() if a['cwd'] is None else a['cwd'], dict(os.environ if env is None else env), a['restore_signals'], a['start_new_session']])
+            ok, obj = _recvobj(conn)
+        except:
+            conn.close()
+            raise
+        finally:
+            self._close_pipe_fds(*(a[k] for k in ['p2cread', 'p2cwrite', 'c2pread', 'c2pwrite', 'errread', 'errwrite']))
+        if not ok:
+            conn.close()
+            raise obj
+        self.pid = obj
+        self._child_created = True
+        self.conn = conn
+
+    def _waitpid(self, pid, options):
+        if self.conn is None:
+            return os.waitpid(pid, options)
+        if options & os.WNOHANG and not select.select([self.conn], [], [], 0)[0]:
+            return 0, 0
+        try:
+            returncode = _recvobj(self.conn)
+        except EOFError:
+            raise OSError('Fork server died.')
+        self.conn.close()
+        return pid, waitstatus(returncode)
+
+    def _try_wait(self, wait_flags):
+        if self.conn is None:
+            return super()._try_wait(wait_flags)
+        return self._waitpid(self.pid, wait_flags)
+
+    def _internal_poll(self, *args, **kwargs):
+        return super()._internal_poll(*args, **dict(kwargs, _waitpid = self._waitpid))
+
+    def send_signal(self, sig):
+        if self.conn is None:
+            return super().send_signal(sig)
+        self.poll()
+        if self.returncode is None:
+            try:
+                _sendobj(self.conn, sig)
+            except OSError: # Exit status was received meanwhile, so the signal would be too late anyway.
+                pass
+
+def _serve(connfd, *stdfds):
+    with socket.socket(fileno = connfd) as conn:
+        try:
+            args, executable, cwd, env, restore_signals, start_new_session = _recvobj(conn)
+            try:
+                process = subprocess.Popen(args, executable = executable, stdin = stdfds[0], stdout = stdfds[1], stderr = stdfds[2],
+                        cwd = cwd, env = env, restore_signals = restore_signals, start_new_session = start_new_session)
+            finally:
+                for fd in stdfds:
+                    os.close(fd)
+        except Exception as e:
+            _sendobj(conn, [False, e])
+            return
+        _sendobj(conn, [True, process.pid])
+        def signals():
+            try:
+                while True:
+                    process.send_signal(_recvobj(conn)) # A no-op once our wait has reaped it.
+            except (EOFError, OSError):
+                pass
+        thread = Thread(target = signals, daemon = True)
+        thread.start()
+        _sendobj(conn, process.wait())
+        conn.shutdown(socket.SHUT_RDWR)
+        thread.join()
+
+def main(fd):
+    control = socket.socket(fileno = fd)
+    while True:
+        msg, fds, _, _ = socket.recv_fds(control, 1, 4)
+        if not msg:
+            break
+        Thread(target = _serve, args = fds, daemon = True).start()
@@ -16,30 +16,160 @@
 # along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
 
 from . import binary
-from .util import onerror, threadlocalproperty, unmangle
-from collections import defaultdict
-from contextlib import ExitStack
+from .util import AbruptOutcome, atomic, contextlocalproperty, executechild, NORMAL, NormalOutcome, onerror, threadlocalproperty, unmangle, waitstatus
+from collections import deque, OrderedDict
+from contextlib import contextmanager, ExitStack
 from diapyr.util import singleton
+from itertools import islice
 from keyword import iskeyword
-from pathlib import Path
-import functools, json, os, re, shlex, subprocess, sys
+from pathlib import Path, PurePath
+from queue import Queue
+from tempfile import TemporaryFile
+from threading import Event, Lock, RLock, Thread
+import codecs, functools, io, json, locale, logging, math, mmap, os, re, shlex, struct, subprocess, sys, time, types
 
+log = logging.getLogger(__name__)
+chunksize = 0x10000
+internsize = 0x1000
+teequeuesize = 64
+argmaxheadroom = 2048
 unimportablechars = re.compile('|'.join(map(re.escape, '+-.[')))
+scans = []
+tracers = []
+inprocess = {} # Program name to the popen that scan binds in place of the default, see lagoon.builtins.
+backends = [] # Functions of the configured popen that return the one to actually use, the last is outermost.
 
 def scan(modulename):
-    programs = {}
-    for parent in os.environ['PATH'].split(os.pathsep):
-        if os.path.isdir(parent):
-            for name in os.listdir(parent):
-                if name not in programs:
-                    programs[name] = os.path.join(parent, name)
     module = sys.modules[modulename]
     delattr(module, scan.__name__)
-    Program._scan(module, binary, programs)
+    index = PathIndex(_searchpath(), _cachepath())
+    Program._scan(module, binary, index)
+    scans.append((module, index))
+
+def refresh():
+    'Make a long-running process see changes to PATH and its directories. Programs already imported by name are unaffected.'
+    for module, index in scans:
+        index.cachepath = _cachepath()
+        index.refresh(_searchpath())
+        for m in module, binary:
+            for name in [k for k, v in vars(m).items() if isinstance(v, Program)]:
+                delattr(m, name)
+
+def _searchpath():
+    return os.environ['PATH'].split(os.pathsep)
+
+def _cachepath():
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache', 'lagoon', 'pathindex')
+
+class PathIndex:
+    '''Resolve program names against the given search path.
+    Exact names are probed, directories are only listed when a name can only be found that way.
+    With a cache file, listings are persisted and reused while the directory's identity and mtime are unchanged.'''
+
+    racysecs = 2
+
+    def __init__(self, parents, cachepath = None):
+        self.parents = [p for p in parents if p]
+        self.cachepath = cachepath
+        self.programs = None
+        self.cache = None
+
+    def refresh(self, parents):
+        self.parents = [p for p in parents if p]
+        self.programs = None
+        self.cache = None
+
+    def _loadcache(self):
+        if self.cache is None:
+            self.cache = {}
+            if self.cachepath is not None:
+                try:
+                    with self.cachepath.open() as f:
+                        self.cache = {parent: (tuple(key), list(names)) for parent, (key, names) in json.load(f).items()}
+                except FileNotFoundError:
+                    pass
+                except Exception:
+                    log.debug('Ignore unreadable cache: %s', self.cachepath, exc_info = True)
+        return self.cache
+
+    def _savecache(self, cache):
+        def entries():
+            for parent, entry in cache.items():
+                try:
+                    st = os.stat(parent)
+                except OSError:
+                    continue
+                if entry[0] == (st.st_dev, st.st_ino, st.st_mtime_ns):
+                    yield parent, entry
+        try:
+            with atomic(self.cachepath) as q, q.open('w') as f:
+                json.dump(dict(entries()), f)
+        except OSError:
+            log.debug('Failed to save cache: %s', self.cachepath, exc_info = True)
+
+    def _listings(self):
+        if self.cachepath is None:
+            for parent in self.parents:
+                if os.path.isdir(parent):
+                    yield parent, os.listdir(parent)
+            return
+        cache = self._loadcache()
+        dirty = False
+        for parent in self.parents:
+            try:
+                st = os.stat(parent)
+            except OSError:
+                continue
+            key = st.st_dev, st.st_ino, st.st_mtime_ns
+            entry = cache.get(parent)
+            if entry is None or entry[0] != key:
+                if not os.path.isdir(parent):
+                    continue
+                names = os.listdir(parent)
+                # Another change within the mtime granularity would go unnoticed, so don't persist a listing that may be racy:
+                if time.time() - st.st_mtime > self.racysecs:
+                    cache[parent] = key, names
+                    dirty = True
+                entry = key, names
+            yield parent, entry[1]
+        if dirty:
+            self._savecache(cache)
+
+    def _allprograms(self):
+        'Map of name to parent directory.'
+        if self.programs is None:
+            programs = {}
+            for parent, names in reversed(list(self._listings())): # Earlier entries win.
+                programs.update(dict.fromkeys(names, parent))
+            self.programs = programs
+        return self.programs
+
+    def pathornone(self, name):
+        if self.programs is not None:
+            parent = self._allprograms().get(name)
+            return None if parent is None else os.path.join(parent, name)
+        if name and os.sep not in name and name not in {os.curdir, os.pardir}:
+            for parent in self.parents:
+                path = os.path.join(parent, name)
+                if os.path.lexists(path):
+                    return path
+
+    def resolve(self, key):
+        path = self.pathornone(key)
+        if path is None and '_' in key: # Only names containing unimportable chars can have an alias.
+            programs = self._allprograms()
+            names = [name for name in programs if Program._importableornone(name) == key]
+            if 1 == len(names):
+                name, = names
+                return os.path.join(programs[name], name)
+        return path
 
 class Program:
+    'Immutable, programs derived via attributes, cd or styles are interned (unless they hold a resource such as a file) so that repeating a chain is cheap.'
 
+    __slots__ = 'path', 'textmode', 'cwd', 'args', 'kwargs', 'runmode', 'ttl', '_compiled'
     bginfo = threadlocalproperty(lambda: None)
+    aiobginfo = contextlocalproperty(lambda: None)
 
     @classmethod
     def _importableornone(cls, anyname):
@@ -52,21 +182,19 @@ class Program:
         return arg if arg is None else str(arg)
 
     @classmethod
-    def _scan(cls, module, binary, programs):
-        def install(key):
-            setattr(module, key, textprogram)
-            setattr(binary, key, binaryprogram)
-        importables = defaultdict(list)
-        for name in programs:
-            importables[cls._importableornone(name)].append(name)
-        for importable, names in importables.items():
-            for name in names:
-                path = programs[name]
-                textprogram = cls.text(path)
-                binaryprogram = cls.binary(path)
-                install(name)
-            if 1 == len(names) and importable not in {None, name}:
-                install(importable)
+    def _scan(cls, module, binary, index):
+        def getattrfactory(thismodule):
+            def __getattr__(name):
+                path = None if name.startswith('__') and name.endswith('__') else index.resolve(name) # Don't let tools probing for dunders cause a scan.
+                if path is None:
+                    raise AttributeError(f"module {thismodule.__name__!r} has no attribute {name!r}")
+                popen = inprocess.get(os.path.basename(path))
+                for m, program in [[module, cls.text(path)], [binary, cls.binary(path)]]:
+                    setattr(m, name, program if popen is None else program[partial](popen = popen))
+                return getattr(thismodule, name)
+            return __getattr__
+        for m in module, binary:
+            m.__getattr__ = getattrfactory(m)
 
     @classmethod
     def text(cls, path):
@@ -84,19 +212,20 @@ class Program:
         self.kwargs = kwargs
         self.runmode = runmode
         self.ttl = ttl
+        self._compiled = None
 
     def _resolve(self, path):
         return Path(path) if self.cwd is None else self.cwd / path
 
     def cd(self, cwd):
-        return _of(self, self.path, self.textmode, self._resolve(cwd), self.args, self.kwargs, self.runmode, self.ttl)
+        return _cd(self, cwd)
 
     def __getattr__(self, name):
-        return _of(self, self.path, self.textmode, self.cwd, self.args + (unmangle(name).replace('_', '-'),), self.kwargs, self.runmode, self.ttl)
+        return _subcommand(self, name)
 
     def __getitem__(self, key):
-        for style in (styles[k] for k in (key if isinstance(key, tuple) else [key])):
-            self = style(self)
+        for k in (key if isinstance(key, tuple) else [key]):
+            self = k(self) if isinstance(k, Style) else _styled(self, k) # Only registered styles are interned, as a parameterised one may hold a sink.
         return self
 
     def _mergedkwargs(self, kwargs):
@@ -106,10 +235,38 @@ class Program:
             d1 = self.kwargs[k]
             if d1 is not None: # Otherwise d2 wins, whatever it is.
                 d2 = kwargs[k]
-                merged[k] = d1 if d2 is None else {**d1, **d2}
+                merged[k] = d1 if d2 is None else EnvOverlay.of(d1).merge(d2)
+        if merged.get(k) is not None:
+            merged[k] = EnvOverlay.of(merged[k])
         return merged
 
     def _transform(self, args, kwargs, checkxform):
+        '''Return the command, Popen kwargs and result transform.
+        The common case of no call kwargs and no readable call args reuses everything but the args from a previous call.'''
+        if kwargs or any(_isreadable(arg) for arg in args):
+            cmd, kwargs, xform = self._transformimpl(args, kwargs, checkxform)
+        else:
+            if self._compiled is None:
+                self._compiled = {}
+            try:
+                cmd, kwargs, xform = self._compiled[checkxform]
+            except KeyError:
+                cmd, kwargs, xform = self._compiled[checkxform] = self._transformimpl((), {}, checkxform)
+            kwargs = kwargs.copy()
+            if kwargs['env'] is not None:
+                kwargs['env'] = EnvOverlay.of(self.kwargs['env']).materialise()
+            cmd = [*cmd, *(arg if isinstance(arg, bytes) else str(arg) for arg in args)]
+        feed = kwargs.pop('feed', None)
+        if backends:
+            for backend in backends:
+                kwargs['popen'] = backend(kwargs['popen'])
+        if tracers:
+            kwargs['popen'] = _tracedpopen(kwargs['popen'])
+        if feed is not None:
+            kwargs['popen'] = functools.partial(_feed, kwargs['popen'], feed)
+        return cmd, kwargs, xform
+
+    def _transformimpl(self, args, kwargs, checkxform):
         args = self.args + args
         kwargs = self._mergedkwargs(kwargs)
         if bool == kwargs.get('check'):
@@ -121,12 +278,12 @@ class Program:
         kwargs.setdefault('stdout', subprocess.PIPE)
         kwargs.setdefault('stderr', None)
         kwargs.setdefault('universal_newlines', self.textmode)
+        kwargs.setdefault('popen', subprocess.Popen)
         kwargs['cwd'] = self._strornone(self._resolve(kwargs['cwd']) if 'cwd' in kwargs else self.cwd)
         env = kwargs.get('env')
-        kwargs['env'] = (None if env is None else
-                {**{k: v for k, v in os.environ.items() if env.get(k, v) is not None}, **{k: v for k, v in env.items() if v is not None}})
+        kwargs['env'] = None if env is None else env.materialise()
         aux = kwargs.pop('aux', None)
-        readables = {i for i, f in enumerate(args) if getattr(f, 'readable', lambda: False)()}
+        readables = {i for i, f in enumerate(args) if _isreadable(f)}
         if readables:
             i, = readables
             if 'stdin' in kwargs:
@@ -161,6 +318,10 @@ class Program:
                 pass
         except StopIteration:
             xform = lambda res: None
+        stdin = kwargs.get('stdin')
+        if not (stdin is None or isinstance(stdin, (int, str, bytes)) or hasattr(stdin, 'fileno')) and hasattr(stdin, '__iter__'):
+            kwargs['stdin'] = subprocess.PIPE
+            kwargs['feed'] = stdin
         return [self._xformpath(), *transformargs()], kwargs, xform
 
     def _xformpath(self):
@@ -178,12 +339,16 @@ class Program:
     def __str__(self):
         return ' '.join(shlex.quote(str(w)) for w in [self.path, *self.args])
 
+    def __or__(self, other):
+        return Pipeline([self]) | other
+
     def __enter__(self):
         assert not self.ttl
-        cmd, kwargs, xform = self._transform((), {}, lambda mapcode, res: lambda: mapcode(res.wait()))
+        _checknotmemo(self)
+        cmd, kwargs, xform = self._transform((), {}, _waitcheck)
         check = kwargs.pop('check')
         stack = ExitStack()
-        process = stack.enter_context(subprocess.Popen(cmd, **kwargs))
+        process = stack.enter_context(kwargs.pop('popen')(cmd, **kwargs))
         with onerror(stack.close):
             result = xform(process)
             self.bginfo = self.bginfo, cmd, check, stack, process
@@ -195,6 +360,461 @@ class Program:
         if check and process.returncode:
             raise subprocess.CalledProcessError(process.returncode, cmd)
 
+    async def __aenter__(self):
+        'Like bg but using asyncio, note the streams are always binary.'
+        import asyncio
+        assert not self.ttl
+        _checknotmemo(self)
+        cmd, kwargs, xform = self._transform((), {}, _aiowaitcheck)
+        check = kwargs.pop('check')
+        del kwargs['universal_newlines']
+        _aiopopen(kwargs.pop('popen'))
+        process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+        try:
+            result = xform(process)
+        except:
+            await process.communicate()
+            raise
+        self.aiobginfo = self.aiobginfo, cmd, check, process
+        return result
+
+    async def __aexit__(self, *exc_info):
+        self.aiobginfo, cmd, check, process = self.aiobginfo
+        await process.communicate() # Drain any unread output so that the wait can't deadlock.
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+class EnvOverlay:
+    '''Snapshot of changes to os.environ, where None means delete.
+    The materialised env is cached until os.environ changes, and must not be modified.'''
+
+    @classmethod
+    def of(cls, env):
+        return env if isinstance(env, cls) else cls(env)
+
+    def __init__(self, overlay):
+        self.overlay = dict(overlay.overlay if isinstance(overlay, EnvOverlay) else overlay)
+        self.cached = None, None
+
+    def merge(self, other):
+        return type(self)({**self.overlay, **(other.overlay if isinstance(other, EnvOverlay) else other)})
+
+    def materialise(self):
+        data = getattr(os.environ, '_data', os.environ) # Comparing the raw dict is much cheaper than decoding every item.
+        snapshot, env = self.cached
+        if snapshot != data:
+            overlay = self.overlay
+            env = {**{k: v for k, v in os.environ.items() if overlay.get(k, v) is not None}, **{k: v for k, v in overlay.items() if v is not None}}
+            self.cached = dict(data), env
+        return env
+
+class Pipeline:
+
+    def __init__(self, programs):
+        self.programs = programs
+
+    def __or__(self, other):
+        return type(self)([*self.programs, *(other.programs if isinstance(other, Pipeline) else [other])])
+
+    def __str__(self):
+        return ' | '.join(map(str, self.programs))
+
+    def __call__(self, **kwargs):
+        '''Run the programs with each stdout connected directly to the next stdin, kwargs apply to the last program.
+        Each program is checked according to its own kwargs, like pipefail the rightmost failure is raised.
+        Otherwise the result of the last program is returned, subject to its styles, which can't include a mode.
+        The stderr of an earlier program may be piped, in which case it's drained as it arrives and attached to the error if that program fails.'''
+        assert not any(p.ttl for p in self.programs)
+        if any(p.runmode is not _fgmode for p in self.programs):
+            raise ValueError('Programs of a pipeline can only have the default mode.')
+        if self.programs[-1]._mergedkwargs(kwargs).get('input') is not None:
+            raise ValueError('Only the first program of a pipeline can have input.')
+        with ExitStack() as stack:
+            stages = []
+            drains = []
+            stdin = None
+            for program in self.programs[:-1]:
+                cmd, pkwargs, _ = program._transform((), {} if stdin is None else dict(stdin = stdin), _nocheck)
+                pkwargs.update(stdout = subprocess.PIPE, universal_newlines = False)
+                check = pkwargs.pop('check')
+                if stdin is not None and pkwargs.get('input') is not None:
+                    raise ValueError('Only the first program of a pipeline can have input.')
+                _feedinput(pkwargs)
+                process = stack.enter_context(pkwargs.pop('popen')(cmd, **pkwargs))
+                if stdin is not None:
+                    stdin.close() # Only the child should have it, so that SIGPIPE works.
+                stdin = process.stdout
+                stderr = []
+                if process.stderr is not None: # Otherwise a chatty stage could fill the pipe and block.
+                    drains.append(Thread(target = _drain, args = (process.stderr, program.textmode, stderr), daemon = True))
+                    drains[-1].start()
+                stages.append((cmd, check, process, stderr))
+            cmd, kwargs, xform = self.programs[-1]._transform((), dict(kwargs, stdin = stdin), _returncodecheck)
+            kwargs.pop('input', None)
+            check = kwargs.pop('check')
+            with kwargs.pop('popen')(cmd, **kwargs) as process:
+                stdin.close()
+                try:
+                    stdout, stderr = process.communicate()
+                except:
+                    process.kill()
+                    raise
+            stages.append((cmd, check, process, [stderr]))
+            for _, _, p, _ in stages:
+                p.wait()
+            for thread in drains:
+                thread.join()
+        for stagecmd, stagecheck, p, stageerr in reversed(stages):
+            if stagecheck and p.returncode:
+                raise subprocess.CalledProcessError(p.returncode, stagecmd, stdout if p is process else None, *stageerr)
+        return xform(subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr))
+
+class GroupMember:
+
+    def __init__(self, cmd, check, process, pidfd, decoders, callbacks):
+        self.cmd = cmd
+        self.check = check
+        self.process = process
+        self.pidfd = pidfd
+        self.decoders = decoders
+        self.callbacks = callbacks
+        self.streams = len(decoders)
+        self.exited = pidfd is None
+
+class ProcessGroup:
+    '''Run many programs at once, reading all their stdout and stderr that are pipes via one selector loop in the calling thread.
+    Where available a pidfd is used to notice each exit, otherwise a member is waited for once its pipes are closed.
+    Any members still running when the context exits are killed.'''
+
+    def __init__(self):
+        import selectors
+        self.selector = selectors.DefaultSelector()
+        self.members = []
+        self.pending = []
+
+    def add(self, program, *args, onstdout = None, onstderr = None, **kwargs):
+        '''Start the program with the given args and kwargs, and return its GroupMember.
+        The optional callbacks are called with each chunk of decoded output by run.'''
+        cmd, kwargs, _ = program._transform(args, kwargs, _nocheck)
+        return self._start(cmd, kwargs.pop('check'), kwargs, dict(stdout = onstdout, stderr = onstderr))
+
+    def _start(self, cmd, check, kwargs, callbacks):
+        from selectors import EVENT_READ
+        textmode = kwargs['universal_newlines']
+        kwargs['universal_newlines'] = False
+        _feedinput(kwargs)
+        process = kwargs.pop('popen')(cmd, **kwargs)
+        try:
+            pidfd = None if process.pid is None else os.pidfd_open(process.pid) # No pid for a replayed process.
+        except (AttributeError, OSError):
+            pidfd = None
+        streams = {name: stream for name in ['stdout', 'stderr'] for stream in [getattr(process, name)] if stream is not None}
+        member = GroupMember(cmd, check, process, pidfd, {name: io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(locale.getpreferredencoding(False))(), True) if textmode else None for name in streams}, callbacks)
+        self.members.append(member)
+        for name, stream in streams.items():
+            self.selector.register(stream, EVENT_READ, (member, name))
+        if pidfd is not None:
+            self.selector.register(pidfd, EVENT_READ, (member, None))
+        elif not streams:
+            self.pending.append(member)
+        return member
+
+    def _exit(self, member):
+        returncode = member.process.wait()
+        if member.check and returncode:
+            raise subprocess.CalledProcessError(returncode, member.cmd)
+        return member, 'returncode', returncode
+
+    def events(self):
+        '''Yield (member, name, value) for each chunk of output, where name is stdout or stderr, and (member, 'returncode', returncode) when a member has finished.
+        Members can be added while iterating. A checked member that fails raises CalledProcessError instead.'''
+        while self.selector.get_map() or self.pending:
+            if not self.selector.get_map():
+                yield self._exit(self.pending.pop(0))
+                continue
+            for key, _ in self.selector.select():
+                member, name = key.data
+                if name is None:
+                    self.selector.unregister(key.fileobj)
+                    os.close(member.pidfd)
+                    member.exited = True
+                else:
+                    raw = os.read(key.fd, chunksize)
+                    decoder = member.decoders[name]
+                    data = raw if decoder is None else decoder.decode(raw, not raw)
+                    if data:
+                        yield member, name, data
+                    if raw:
+                        continue
+                    self.selector.unregister(key.fileobj)
+                    member.streams -= 1
+                if not member.streams and member.exited:
+                    yield self._exit(member)
+
+    def run(self):
+        'Consume all events, passing output to the callbacks of its member.'
+        for member, name, value in self.events():
+            callback = member.callbacks.get(name)
+            if callback is not None:
+                callback(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for member in self.members:
+            if member.process.poll() is None:
+                member.process.kill()
+            with member.process:
+                pass
+            if not member.exited:
+                os.close(member.pidfd)
+        self.selector.close()
+
+class SpawnPopen(subprocess.Popen):
+    '''Popen that allows subprocess to launch via os.posix_spawn when the kwargs permit, otherwise behaves normally.
+    Note in that case fds explicitly made inheritable are not closed in the child.'''
+
+    spawnkeys = {'bufsize', 'encoding', 'env', 'errors', 'restore_signals', 'stderr', 'stdin', 'stdout', 'text', 'universal_newlines'}
+
+    @staticmethod
+    def _childfd(stream):
+        if stream is None:
+            return -1
+        if stream in {subprocess.PIPE, subprocess.DEVNULL}:
+            return sys.maxsize # Some fresh fd.
+        return stream if isinstance(stream, int) else stream.fileno()
+
+    @classmethod
+    def _spawnable(cls, args, kwargs):
+        if not (isinstance(args, (list, tuple)) and os.path.dirname(args[0])):
+            return False
+        if not all(k in cls.spawnkeys or v is None for k, v in kwargs.items()):
+            return False
+        stdout = cls._childfd(kwargs.get('stdout'))
+        stderr = kwargs.get('stderr')
+        return all(fd == -1 or fd > 2 for fd in [cls._childfd(kwargs.get('stdin')), stdout, stdout if subprocess.STDOUT == stderr else cls._childfd(stderr)])
+
+    def __init__(self, args, **kwargs):
+        if self._spawnable(args, kwargs):
+            kwargs['close_fds'] = False
+        super().__init__(args, **kwargs)
+
+class Trace:
+    '''Record of one process, passed to each tracer when lagoon is done with the process.
+    The rusage fields are None if the process was not reaped by lagoon, and everything but cmd and cwd is None if it replaced this process via exec.
+    Captured is the length of the stdout plus stderr returned by the call, or None if lagoon did not consume them.'''
+
+    wall = returncode = rusage = captured = None
+
+    def __init__(self, cmd, cwd):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.start = time.perf_counter()
+
+    def end(self, returncode):
+        self.wall = time.perf_counter() - self.start
+        self.returncode = returncode
+
+    @property
+    def utime(self):
+        return None if self.rusage is None else self.rusage.ru_utime
+
+    @property
+    def stime(self):
+        return None if self.rusage is None else self.rusage.ru_stime
+
+    @property
+    def maxrss(self):
+        'In the units of getrusage, KiB on Linux.'
+        return None if self.rusage is None else self.rusage.ru_maxrss
+
+class TracedPopen(subprocess.Popen):
+    '''Base of the class a process from any Popen factory is given while tracing, that passes its Trace to every tracer on exit.
+    Where the process is a child of this one it's reaped via wait4 to collect rusage.'''
+
+    def wait(self, timeout = None):
+        if timeout is None and self.returncode is None and self.pid is not None:
+            try:
+                _, status, self.trace.rusage = os.wait4(self.pid, 0)
+            except ChildProcessError: # Not our child, or already reaped.
+                pass
+            else:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        returncode = super().wait(timeout)
+        if self.trace.wall is None:
+            self.trace.end(returncode)
+        return returncode
+
+    def communicate(self, *args, **kwargs):
+        stdout, stderr = super().communicate(*args, **kwargs)
+        self.trace.captured = sum(len(data) for data in [stdout, stderr] if data is not None)
+        return stdout, stderr
+
+    def __exit__(self, *exc_info):
+        try:
+            return super().__exit__(*exc_info)
+        finally:
+            if self.trace.wall is None: # Not waited for by us, e.g. reaped by poll.
+                self.trace.end(self.returncode)
+            for tracer in list(tracers):
+                tracer(self.trace)
+
+@functools.lru_cache()
+def _tracedclass(cls):
+    return cls if issubclass(cls, TracedPopen) else type(f"Traced{cls.__name__}", (TracedPopen, cls), {})
+
+def _traced(popen, args, **kwargs):
+    trace = Trace(args, kwargs.get('cwd'))
+    process = popen(args, **kwargs)
+    if isinstance(process, subprocess.Popen):
+        process.__class__ = _tracedclass(type(process))
+        process.trace = trace
+    return process
+
+@functools.lru_cache()
+def _tracedpopen(popen):
+    'Return a factory that traces whatever popen returns, the same one each time so that memo keys are stable.'
+    return functools.partial(_traced, popen)
+
+@contextmanager
+def tracing(tracer):
+    '''Call the given tracer with a Trace after every process run by lagoon within this block, in any thread.
+    When no tracer is installed the cost is a single truthiness check per call.'''
+    tracers.append(tracer)
+    try:
+        yield tracer
+    finally:
+        tracers.remove(tracer)
+
+class ProgramStats:
+
+    def __init__(self):
+        self.count = self.failures = self.captured = 0
+        self.wall = self.utime = self.stime = 0.
+        self.maxrss = None
+        self.histogram = {}
+
+    def add(self, trace):
+        self.count += 1
+        self.failures += bool(trace.returncode)
+        self.captured += trace.captured or 0
+        self.wall += trace.wall
+        if trace.rusage is not None:
+            self.utime += trace.utime
+            self.stime += trace.stime
+            self.maxrss = max(self.maxrss or 0, trace.maxrss)
+        bucket = max(0, math.frexp(trace.wall * 1000)[1])
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+class Aggregator:
+    '''Tracer that keeps a ProgramStats per program path.
+    The histogram maps n to the number of runs that took less than 2 ** n milliseconds (and at least half that).'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.programs = {}
+
+    def __call__(self, trace):
+        if trace.wall is None:
+            return # Exec.
+        with self.lock:
+            try:
+                stats = self.programs[trace.cmd[0]]
+            except KeyError:
+                stats = self.programs[trace.cmd[0]] = ProgramStats()
+            stats.add(trace)
+
+class InProcessPopen(subprocess.Popen):
+    '''Popen that gets its outcome from a function of args, cwd, env, the input bytes (None if stdin was inherited), whether stderr is merged, and the original kwargs.
+    Nothing is launched, instead a thread stands in for the child, reading stdin until EOF and writing the outcome to the usual fds.
+    If the outcome fails, the first wait raises the error and the stand-in then counts as exited with status 1.'''
+
+    def __init__(self, outcome, args, **kwargs):
+        self.outcome = outcome
+        self.kwargs = kwargs
+        super().__init__(args, **kwargs)
+
+    def _execute_child(self, *args, **kwargs):
+        a = executechild().bind(self, *args, **kwargs).arguments
+        p2cread, c2pwrite, errwrite = (a[k] for k in ['p2cread', 'c2pwrite', 'errwrite'])
+        fds = [None if p2cread == -1 else os.dup(p2cread), os.dup(1 if c2pwrite == -1 else c2pwrite), os.dup(2 if errwrite == -1 else errwrite)]
+        merged = errwrite != -1 and errwrite == c2pwrite
+        self._close_pipe_fds(*(a[k] for k in ['p2cread', 'p2cwrite', 'c2pread', 'c2pwrite', 'errread', 'errwrite']))
+        self.pid = None
+        self._child_created = True
+        self.signal = self.error = None
+        self.done = Event()
+        try:
+            child = self._launch(a, fds, merged)
+        except:
+            for fd in fds:
+                if fd is not None:
+                    os.close(fd)
+            raise
+        def run():
+            try:
+                self.status = waitstatus(child())
+            except BaseException as e:
+                self.error = e
+                self.status = waitstatus(1)
+            finally:
+                for fd in fds:
+                    if fd is not None:
+                        os.close(fd)
+                self.done.set()
+        Thread(target = run, daemon = True).start()
+
+    def _launch(self, a, fds, merged):
+        'Return the function that runs in the stand-in thread, given the bound _execute_child args and the std fds, and returns the returncode.'
+        def child():
+            returncode, stdout, stderr = self.outcome(a['args'], a['cwd'], a['env'], None if fds[0] is None else _readall(fds[0]), merged, self.kwargs)
+            try:
+                _writeall(fds[1], stdout)
+                if not merged:
+                    _writeall(fds[2], stderr)
+            except BrokenPipeError:
+                pass
+            return returncode
+        return child
+
+    def _waitpid(self, pid, options):
+        if options & os.WNOHANG and not self.done.is_set():
+            return 0, 0
+        self.done.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return pid, self.status if self.signal is None else self.signal
+
+    def _try_wait(self, wait_flags):
+        return self._waitpid(self.pid, wait_flags)
+
+    def _internal_poll(self, *args, **kwargs):
+        return super()._internal_poll(*args, **dict(kwargs, _waitpid = self._waitpid))
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            self.signal = sig
+
+def _drain(stream, textmode, result):
+    with stream:
+        data = stream.read()
+    result.append(data.decode(locale.getpreferredencoding(False)) if textmode else data)
+
+def _readall(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, chunksize)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+def _writeall(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
 @singleton
 class NOEOL:
 
@@ -207,9 +827,90 @@ def ONELINE(text):
     l, = text.splitlines()
     return l
 
+def _feed(popen, chunks, cmd, **kwargs):
+    '''Launch via popen and write the iterable of str/bytes chunks to stdin from a thread, so that the producer and child run at the same time.
+    Feeding stops quietly if the child closes its stdin. If the producer fails the error is logged and the child killed.'''
+    process = popen(cmd, **kwargs)
+    stream = process.stdin
+    process.stdin = None # Owned by the feeder, so that communicate won't write or close it.
+    if isinstance(stream, io.TextIOBase):
+        stream = stream.detach()
+    encoding = locale.getpreferredencoding(False)
+    def feed():
+        try:
+            with stream:
+                for chunk in chunks:
+                    stream.write(chunk.encode(encoding) if isinstance(chunk, str) else chunk)
+                    stream.flush()
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            log.exception("Failed to feed stdin of: %s", cmd)
+            process.kill()
+        finally:
+            getattr(chunks, 'close', lambda: None)()
+    Thread(target = feed, daemon = True).start()
+    return process
+
+def _feedinput(kwargs):
+    'Replace any input kwarg with a stdin pipe that is fed from a thread, for modes that can not use communicate.'
+    input = kwargs.pop('input', None)
+    if input is not None:
+        if kwargs.get('stdin') is not None:
+            raise ValueError('stdin and input arguments may not both be used.')
+        kwargs['stdin'] = subprocess.PIPE
+        kwargs['popen'] = functools.partial(_feed, kwargs['popen'], [input])
+
+def _isreadable(arg):
+    return getattr(arg, 'readable', lambda: False)()
+
+def _returncodecheck(mapcode, res):
+    return mapcode(res.returncode)
+
+def _waitcheck(mapcode, res):
+    return lambda: mapcode(res.wait())
+
+def _aiowaitcheck(mapcode, res):
+    return functools.partial(_aiowait, mapcode, res)
+
+def _nocheck(mapcode, res):
+    pass
+
 def _of(program, *args, **kwargs):
     return type(program)(*args, **kwargs)
 
+_plaintypes = str, bytes, int, float, type(None), PurePath, EnvOverlay, type, types.FunctionType, types.BuiltinFunctionType
+
+def _isplain(obj):
+    'True if obj is made only of values that are immutable and hold no resources, such as an open file.'
+    if isinstance(obj, _plaintypes):
+        return True
+    if isinstance(obj, (tuple, frozenset)):
+        return all(_isplain(x) for x in obj)
+    if isinstance(obj, functools.partial):
+        return _isplain(obj.func) and _isplain(obj.args) and all(_isplain(v) for v in obj.keywords.values())
+    return False
+
+def _interned(f):
+    'Like lru_cache, but a program holding anything that is not plain is never cached, so that e.g. a bound file is not kept open.'
+    cached = functools.lru_cache(internsize)(f)
+    @functools.wraps(f)
+    def g(program, key):
+        return (cached if _isplain(program.args) and all(_isplain(v) for v in program.kwargs.values()) and _isplain(program.runmode) else f)(program, key)
+    return g
+
+@_interned
+def _cd(program, cwd):
+    return _of(program, program.path, program.textmode, program._resolve(cwd), program.args, program.kwargs, program.runmode, program.ttl)
+
+@_interned
+def _subcommand(program, name):
+    return _of(program, program.path, program.textmode, program.cwd, program.args + (unmangle(name).replace('_', '-'),), program.kwargs, program.runmode, program.ttl)
+
+@_interned
+def _styled(program, key):
+    return styles[key](program)
+
 def _boolstyle(program):
     return program[partial](check = bool)
 
@@ -217,36 +918,651 @@ def _partialstyle(program):
     return _of(program, program.path, program.textmode, program.cwd, program.args, program.kwargs, program.runmode, program.ttl + 1)
 
 def _fgmode(program, *args, **kwargs):
-    cmd, kwargs, xform = program._transform(args, kwargs, lambda mapcode, res: mapcode(res.returncode))
-    return xform(subprocess.run(cmd, **kwargs))
+    cmd, kwargs, xform = program._transform(args, kwargs, _returncodecheck)
+    return xform(_run(cmd, **kwargs))
+
+def _run(cmd, popen, input = None, timeout = None, check = False, **kwargs):
+    'Like subprocess.run but using the given Popen factory.'
+    if input is not None:
+        if kwargs.get('stdin') is not None:
+            raise ValueError('stdin and input arguments may not both be used.')
+        kwargs['stdin'] = subprocess.PIPE
+    with popen(cmd, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout)
+        except subprocess.TimeoutExpired as e:
+            process.kill()
+            e.output, e.stderr = process.communicate()
+            raise
+        except:
+            process.kill()
+            raise
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stdout, stderr)
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
 
 def _stdoutstyle(token):
     return lambda program: program[partial](stdout = token)
 
-def _teestyle(program):
-    return _of(program, program.path, program.textmode, program.cwd, program.args, program.kwargs, _teemode, program.ttl)
+def _forkserverstyle(program):
+    from .forkserver import ForkServerPopen, supported
+    return program[partial](popen = ForkServerPopen) if supported else program
+
+def _popenstyle(popen):
+    return lambda program: program[partial](popen = popen)
+
+class Style:
+    'Marker base of parameterised styles, which can be used as program keys like the registered styles. Subclasses are called with the program to style.'
+
+class ModeStyle(Style):
+
+    def __init__(self, runmode):
+        self.runmode = runmode
+
+    def __call__(self, program):
+        _checknotmemo(program)
+        return _of(program, program.path, program.textmode, program.cwd, program.args, program.kwargs, self.runmode, program.ttl)
+
+def _checknotmemo(program):
+    if isinstance(program.runmode, functools.partial) and program.runmode.func is _memomode:
+        raise ValueError('memo only works with the default mode.')
+
+def _aiomode(program, *args, **kwargs):
+    return _aiorun(*program._transform(args, kwargs, _returncodecheck))
+
+async def _aiorun(cmd, kwargs, xform):
+    import asyncio
+    check = kwargs.pop('check')
+    text = kwargs.pop('universal_newlines')
+    _aiopopen(kwargs.pop('popen'))
+    input = kwargs.pop('input', None)
+    encoding = locale.getpreferredencoding(False)
+    if input is not None:
+        if kwargs.get('stdin') is not None:
+            raise ValueError('stdin and input arguments may not both be used.')
+        kwargs['stdin'] = subprocess.PIPE
+        if text:
+            input = input.encode(encoding)
+    process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    try:
+        stdout, stderr = await process.communicate(input)
+    except:
+        process.kill()
+        raise
+    if text:
+        stdout, stderr = (None if data is None else data.decode(encoding).replace('\r\n', '\n').replace('\r', '\n') for data in [stdout, stderr])
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return xform(subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr))
+
+def _aiopopen(popen):
+    if isinstance(popen, functools.partial) and popen.func is _feed:
+        raise ValueError('Iterable stdin is not supported with aio.')
+
+async def _aiowait(mapcode, process):
+    return mapcode(await process.wait())
+
+class LogSink:
+    'Tee sink that logs each line.'
+
+    def __init__(self, logger, level = logging.INFO):
+        self.logger = logger
+        self.level = level
+        self.partial = None
+
+    def write(self, data):
+        if self.partial:
+            data = self.partial + data
+        *lines, self.partial = data.split('\n' if isinstance(data, str) else b'\n')
+        for line in lines:
+            self.logger.log(self.level, '%s', line)
+
+    def end(self):
+        if self.partial:
+            self.logger.log(self.level, '%s', self.partial)
+
+def _teesink(sink):
+    if isinstance(sink, logging.Logger):
+        sink = LogSink(sink)
+    if isinstance(sink, LogSink):
+        return sink.write, sink.end
+    if hasattr(sink, 'write'):
+        def write(data):
+            sink.write(data)
+            sink.flush()
+        return write, lambda: None
+    return sink, lambda: None
+
+class Tail:
+    'Retain the last size chars (or bytes) and/or lines of a stream, or all of it if neither is given.'
+
+    def __init__(self, size, lines):
+        self.chunks = deque()
+        self.total = self.newlines = 0
+        self.size = size
+        self.lines = lines
+
+    def append(self, chunk):
+        nl = '\n' if isinstance(chunk, str) else b'\n'
+        self.chunks.append(chunk)
+        self.total += len(chunk)
+        self.newlines += chunk.count(nl)
+        while len(self.chunks) > 1:
+            first = self.chunks[0]
+            if not ((self.size is not None and self.total - len(first) >= self.size)
+                    or (self.lines is not None and self.newlines - first.count(nl) > self.lines)):
+                break
+            self.chunks.popleft()
+            self.total -= len(first)
+            self.newlines -= first.count(nl)
+
+    def value(self, empty):
+        text = empty.join(self.chunks)
+        if self.size is not None:
+            text = text[max(0, len(text) - self.size):]
+        if self.lines is not None:
+            nl = '\n' if isinstance(empty, str) else b'\n'
+            i = len(text) - text.endswith(nl)
+            for _ in range(self.lines):
+                i = text.rfind(nl, 0, i)
+                if i < 0:
+                    return text
+            text = text[i + 1:]
+        return text
+
+def tee(*sinks, tailsize = None, taillines = None):
+    '''Style that copies stdout to the given sinks (default sys.stdout) as it arrives, and returns it.
+    A sink may be a file, a logger or a callable. Sinks are written from a separate thread so that a slow sink doesn't immediately hold up the program.
+    To bound memory use, only the last tailsize chars (or bytes) and/or taillines lines are returned.'''
+    return ModeStyle(functools.partial(_teemode, sinks, tailsize, taillines))
+
+def _teemode(sinks, tailsize, taillines, program, *args, **kwargs):
+    textmode = program.textmode
+    sinks = [_teesink(s) for s in (sinks or [sys.stdout if textmode else sys.stdout.buffer])]
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(locale.getpreferredencoding(False))(), True) if textmode else None
+    tail = Tail(tailsize, taillines)
+    queue = Queue(teequeuesize)
+    errors = []
+    def writer():
+        while True:
+            data = queue.get()
+            if data is None:
+                break
+            if not errors:
+                try:
+                    for write, _ in sinks:
+                        write(data)
+                except BaseException as e:
+                    errors.append(e)
+        if not errors:
+            try:
+                for _, end in sinks:
+                    end()
+            except BaseException as e:
+                errors.append(e)
+    cmd, kwargs, _ = program._transform(args, dict(kwargs, universal_newlines = False), _nocheck)
+    kwargs['stdout'] = subprocess.PIPE
+    check = kwargs.pop('check')
+    total = 0
+    with kwargs.pop('popen')(cmd, **kwargs) as process:
+        thread = Thread(target = writer)
+        thread.start()
+        try:
+            for chunk in iter(functools.partial(process.stdout.read1, chunksize), b''):
+                total += len(chunk)
+                if textmode:
+                    chunk = decoder.decode(chunk)
+                if chunk:
+                    queue.put(chunk)
+                    tail.append(chunk)
+            if textmode:
+                chunk = decoder.decode(b'', True)
+                if chunk:
+                    queue.put(chunk)
+                    tail.append(chunk)
+        finally:
+            queue.put(None)
+            thread.join()
+        if isinstance(process, TracedPopen):
+            process.trace.captured = total
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    if errors:
+        raise errors[0]
+    return tail.value('' if textmode else b'')
+
+class Memo(Style):
+    '''Style that reuses the outcome of a call for ttl seconds, keyed on argv, cwd, effective env and the other kwargs.
+    The least recently used entries beyond maxsize are evicted, and an outcome is only stored if the cache predicate accepts it.
+    Results are shared between callers so should not be modified. Calls with a stdin are never memoised, and only the default mode can be combined with it.'''
+
+    def __init__(self, ttl, maxsize, cache):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cache = cache
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __call__(self, program):
+        if program.runmode is not _fgmode:
+            raise ValueError('memo only works with the default mode.')
+        return ModeStyle(functools.partial(_memomode, self))(program)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+@functools.lru_cache()
+def memo(ttl, maxsize = 128, cache = NORMAL):
+    'Return a Memo style, which is shared by all callers with the same params so that it can be written inline.'
+    return Memo(ttl, maxsize, cache)
+
+def _memomode(memo, program, *args, **kwargs):
+    cmd, pkwargs, _ = program._transform(args, kwargs, _returncodecheck)
+    if pkwargs.get('stdin') not in {None, subprocess.DEVNULL}:
+        return _fgmode(program, *args, **kwargs)
+    env = pkwargs['env']
+    key = tuple(cmd), frozenset((os.environ if env is None else env).items()), tuple(sorted((k, v) for k, v in pkwargs.items() if k not in {'env', 'popen'}))
+    try:
+        hash(key)
+    except TypeError: # Some kwargs may legitimately be lists, such as pass_fds.
+        return _fgmode(program, *args, **kwargs)
+    with memo.lock:
+        try:
+            expiry, outcome = memo.entries[key]
+        except KeyError:
+            pass
+        else:
+            if time.monotonic() < expiry:
+                memo.entries.move_to_end(key)
+                return outcome.result()
+            del memo.entries[key]
+    try:
+        outcome = NormalOutcome(_fgmode(program, *args, **kwargs))
+    except Exception as e:
+        outcome = AbruptOutcome(e)
+    if memo.cache(outcome):
+        with memo.lock:
+            memo.entries[key] = time.monotonic() + memo.ttl, outcome
+            memo.entries.move_to_end(key)
+            while len(memo.entries) > memo.maxsize:
+                memo.entries.popitem(False)
+    return outcome.result()
+
+def tofile(path):
+    '''Style that sends stdout directly to the given path, which is replaced atomically if the program succeeds (or isn't checked).
+    The Path stands in for stdout in the result.'''
+    return ModeStyle(functools.partial(_tofilemode, Path(path)))
+
+def _tofilemode(path, program, *args, **kwargs):
+    with atomic(path) as q, q.open('wb') as f:
+        return _filemode(program, args, kwargs, f, lambda: path)
+
+def _mmapmode(program, *args, **kwargs):
+    '''Send stdout to an anonymous temp file and return it as a read-only memoryview of an mmap, always binary.
+    Output never passes through Python memory, and slicing the view doesn't copy.'''
+    with TemporaryFile() as f:
+        def view():
+            size = os.fstat(f.fileno()).st_size
+            return memoryview(mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ) if size else b'') # The mmap has its own fd.
+        return _filemode(program, args, kwargs, f, view)
+
+def _filemode(program, args, kwargs, f, stdout):
+    cmd, kwargs, xform = program._transform(args, kwargs, _returncodecheck)
+    if kwargs['stdout'] != subprocess.PIPE:
+        raise ValueError('stdout must be captured.')
+    kwargs['stdout'] = f
+    result = _run(cmd, **kwargs)
+    result.stdout = stdout()
+    return xform(result)
+
+class HeadTail:
+    'Retain the first head and last tail chars (or bytes) of a stream.'
+
+    def __init__(self, head, tail):
+        self.head = []
+        self.headroom = head
+        self.tail = Tail(tail, None)
+        self.total = 0
+
+    def append(self, chunk):
+        self.total += len(chunk)
+        if self.headroom:
+            self.head.append(chunk[:self.headroom])
+            self.headroom -= len(self.head[-1])
+            chunk = chunk[len(self.head[-1]):]
+        if chunk:
+            self.tail.append(chunk)
+
+    def value(self, empty):
+        return empty.join(self.head) + self.tail.value(empty)
+
+class CappedProcess(subprocess.CompletedProcess):
+    'CompletedProcess where stdoutdropped and stderrdropped are how many chars (or bytes) were dropped from the middle of each stream.'
+
+    def __init__(self, args, returncode, stdout, stderr, stdoutdropped, stderrdropped):
+        super().__init__(args, returncode, stdout, stderr)
+        self.stdoutdropped = stdoutdropped
+        self.stderrdropped = stderrdropped
+
+def capture(limit = 0x100000, head = 0x10000):
+    '''Style that drains stdout and stderr (a pipe unless specified) at the same time, retaining at most limit chars (or bytes) of each.
+    Of a longer stream the first head and the rest from the end are retained. The CappedProcess is subject to check and the usual transforms.'''
+    return ModeStyle(functools.partial(_capturemode, limit, min(head, limit)))
+
+def _capturemode(limit, head, program, *args, **kwargs):
+    if 'stderr' not in kwargs and 'stderr' not in program.kwargs:
+        kwargs['stderr'] = subprocess.PIPE
+    cmd, kwargs, xform = program._transform(args, kwargs, _returncodecheck)
+    check = kwargs.pop('check')
+    empty = '' if kwargs['universal_newlines'] else b''
+    retainers = {name: HeadTail(head, limit - head) for name in ['stdout', 'stderr']}
+    with ProcessGroup() as group:
+        member = group._start(cmd, False, kwargs, {name: r.append for name, r in retainers.items()})
+        group.run()
+    values = {name: retainers[name].value(empty) if name in member.decoders else None for name in retainers}
+    result = CappedProcess(cmd, member.process.returncode, values['stdout'], values['stderr'], *(0 if v is None else retainers[n].total - len(v) for n, v in values.items()))
+    if check and result.returncode:
+        raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+    return xform(result)
+
+def _linesmode(program, *args, **kwargs):
+    'Return a generator of stdout lines, or chunks in binary mode. The process is checked at the end, or killed if still running when the generator is closed.'
+    cmd, kwargs, _ = program._transform(args, kwargs, _nocheck)
+    kwargs['stdout'] = subprocess.PIPE
+    return _lines(cmd, kwargs.pop('check'), (lambda stdout: stdout) if program.textmode else _chunks, kwargs)
+
+def _chunks(stdout):
+    return iter(functools.partial(stdout.read1, chunksize), b'')
+
+def _lines(cmd, check, read, kwargs):
+    killed = False
+    with kwargs.pop('popen')(cmd, **kwargs) as process:
+        try:
+            yield from read(process.stdout)
+        except BaseException as e:
+            if process.poll() is None:
+                process.kill()
+                killed = True
+            if not isinstance(e, GeneratorExit):
+                raise
+    if check and not killed and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+def ndjson(maxline = 0x100000):
+    '''Style that returns a generator of objects decoded from each line of stdout as it arrives, like lines.
+    A leading record separator is ignored so that RFC 7464 JSON text sequences also work, as are blank lines.
+    A line longer than maxline bytes (including its newline) or malformed is reported with its number and byte offset as ValueError.'''
+    return ModeStyle(functools.partial(_ndjsonmode, maxline))
+
+def _ndjsonmode(maxline, program, *args, **kwargs):
+    cmd, kwargs, _ = program._transform(args, kwargs, _nocheck)
+    kwargs.update(stdout = subprocess.PIPE, universal_newlines = False)
+    return _lines(cmd, kwargs.pop('check'), functools.partial(_ndjsonread, maxline), kwargs)
+
+def _ndjsonread(maxline, stdout):
+    offset = 0
+    for lineno, line in enumerate(iter(functools.partial(stdout.readline, maxline + 1), b''), 1):
+        if len(line) > maxline:
+            raise ValueError(f"Line {lineno} at byte {offset} is longer than {maxline} bytes.")
+        text = line.lstrip(b'\x1e').strip()
+        if text:
+            try:
+                yield json.loads(text)
+            except ValueError as e:
+                raise ValueError(f"Malformed line {lineno} at byte {offset}: {e}") from e
+        offset += len(line)
+
+def _imapmode(program, argsets, workers = None, ordered = True, failfast = False, **kwargs):
+    '''Run the program once per argset with at most the given number of processes at a time, yielding (args, future) pairs in order or as they complete.
+    An argset that isn't a tuple or list is a single arg. Unless failfast, every argset runs regardless of failures.'''
+    from concurrent.futures import as_completed, ThreadPoolExecutor, wait
+    if workers is None:
+        workers = os.cpu_count() or 1
+    argsets = iter(argsets)
+    running = {}
+    lock = RLock() # The callback runs immediately if the future is already done.
+    failed = False
+    def fill():
+        with lock:
+            if failed:
+                return
+            for argset in islice(argsets, 2 * workers - len(running)):
+                args = tuple(argset) if isinstance(argset, (tuple, list)) else (argset,)
+                future = executor.submit(_fgmode, program, *args, **kwargs)
+                running[future] = args
+                if failfast:
+                    future.add_done_callback(check)
+    def check(future):
+        nonlocal failed
+        if not future.cancelled() and future.exception() is not None:
+            with lock:
+                failed = True
+                for f in running:
+                    f.cancel()
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            fill()
+            while running:
+                if ordered:
+                    future = next(iter(running))
+                    wait([future])
+                else:
+                    future = next(as_completed(running))
+                with lock:
+                    args = running.pop(future)
+                fill()
+                yield args, future
+        finally:
+            executor.shutdown(cancel_futures = True)
+
+class Coprocess:
+    '''Long-lived child that is written requests on stdin and replies on stdout, the framing reads one response from the binary stdout.
+    Requests are serialised by a lock. If the child dies during a request that request fails, and a new child is started for the next one.
+    In text mode requests and responses are encoded and decoded, otherwise they are bytes.'''
+
+    def __init__(self, program, args, kwargs, framing):
+        self.program = program
+        self.args = args
+        self.kwargs = kwargs
+        self.framing = framing
+        self.encoding = locale.getpreferredencoding(False) if program.textmode else None
+        self.lock = Lock()
+        self.process = None
+
+    def _start(self):
+        cmd, kwargs, _ = self.program._transform(self.args, dict(self.kwargs, stdin = subprocess.PIPE, universal_newlines = False), _nocheck)
+        del kwargs['check']
+        if kwargs['stdout'] != subprocess.PIPE:
+            raise ValueError('stdout must be captured.')
+        self.process = kwargs.pop('popen')(cmd, **kwargs)
+
+    def _end(self, kill):
+        process, self.process = self.process, None
+        if kill:
+            process.kill()
+        try:
+            with process: # Close the streams and wait.
+                pass
+        except BrokenPipeError:
+            pass
+        return process
+
+    def __call__(self, request):
+        if self.encoding is not None:
+            request = request.encode(self.encoding)
+        with self.lock:
+            if self.process is not None and self.process.poll() is not None:
+                self._end(False)
+            if self.process is None:
+                self._start()
+            try:
+                self.process.stdin.write(request)
+                self.process.stdin.flush()
+                response = self.framing(self.process.stdout)
+            except (BrokenPipeError, EOFError) as e:
+                process = self._end(True)
+                raise subprocess.CalledProcessError(process.returncode, process.args) from e
+        return response if self.encoding is None else response.decode(self.encoding)
+
+    def close(self):
+        with self.lock:
+            if self.process is not None:
+                self._end(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CoprocessPool:
+    'Thread-safe pool of identical coprocesses, each request is served by an idle one. Children are started on demand.'
+
+    def __init__(self, size, factory):
+        self.coprocesses = [factory() for _ in range(size)]
+        self.idle = Queue()
+        for c in self.coprocesses:
+            self.idle.put(c)
+
+    def __call__(self, request):
+        c = self.idle.get()
+        try:
+            return c(request)
+        finally:
+            self.idle.put(c)
+
+    def close(self):
+        for c in self.coprocesses:
+            c.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def coprocess(framing, size = None):
+    '''Style that returns a Coprocess of the program with the call args, or a CoprocessPool of that if size is given, instead of running it.
+    Framing is a function of the stdout stream, see delimited, lengthprefixed and sentinel.'''
+    return ModeStyle(functools.partial(_coprocessmode, framing, size))
+
+def _coprocessmode(framing, size, program, *args, **kwargs):
+    factory = lambda: Coprocess(program, args, kwargs, framing)
+    return factory() if size is None else CoprocessPool(size, factory)
+
+def _readexactly(stdout, n):
+    data = stdout.read(n)
+    if len(data) < n:
+        raise EOFError
+    return data
+
+def delimited(delimiter = b'\n'):
+    'Framing for responses terminated by the given bytes, which are not included.'
+    def read(stdout):
+        data = bytearray()
+        while True:
+            chunk = stdout.peek()
+            if not chunk:
+                raise EOFError
+            overlap = min(len(data), len(delimiter) - 1) # The delimiter may straddle chunks.
+            i = (data[len(data) - overlap:] + chunk).find(delimiter)
+            if i >= 0:
+                data += stdout.read(i + len(delimiter) - overlap)
+                return bytes(data[:-len(delimiter)])
+            data += stdout.read(len(chunk))
+    return read
+
+def lengthprefixed(size = 4, byteorder = 'big'):
+    'Framing for responses preceded by their length as an unsigned int of the given size in bytes, the prefix is not included.'
+    def read(stdout):
+        return _readexactly(stdout, int.from_bytes(_readexactly(stdout, size), byteorder))
+    return read
+
+def sentinel(line):
+    'Framing for responses of any number of lines followed by the given sentinel line, which is not included.'
+    def read(stdout):
+        lines = []
+        while True:
+            l = stdout.readline()
+            if not l:
+                raise EOFError
+            if l == line:
+                return b''.join(lines)
+            lines.append(l)
+    return read
+
+class BatchedProcess(subprocess.CompletedProcess):
+    'Combined result of the xargs style, where batches is the CompletedProcess of each batch in order and returncode is that of the first failure.'
+
+    def __init__(self, args, returncode, stdout, stderr, batches):
+        super().__init__(args, returncode, stdout, stderr)
+        self.batches = batches
+
+class BatchError(subprocess.CalledProcessError):
+    'Raised by a checked xargs style if any batch failed, batches is the CompletedProcess of each batch in order.'
+
+    def __init__(self, returncode, cmd, output, stderr, batches):
+        super().__init__(returncode, cmd, output, stderr)
+        self.batches = batches
+
+    def failures(self):
+        return [b for b in self.batches if b.returncode]
+
+def xargs(workers = 1, maxsize = None, maxargs = None):
+    '''Style that runs the program once per batch of the call args, so that each batch plus the program's own args and env fit in maxsize bytes (default from ARG_MAX).
+    Batches are run on the given number of threads, and their stdout and stderr are combined in order before the usual transforms.
+    Nothing is run if there are no call args.'''
+    return ModeStyle(functools.partial(_xargsmode, workers, maxsize, maxargs))
+
+def _argsize(arg):
+    return len(os.fsencode(arg)) + 1 + struct.calcsize('P') # Including the terminator and pointer.
 
-def _teemode(program, *args, **kwargs):
-    def lines():
-        with program[bg](*args, **kwargs) as stdout:
-            while True:
-                line = stdout.readline()
-                if not line:
-                    break
-                yield line
-                sys.stdout.write(line)
-    return ''.join(lines())
+def _batches(fixedsize, args, maxsize, maxargs):
+    batch = []
+    size = fixedsize
+    for arg in args:
+        n = _argsize(arg)
+        if batch and (size + n > maxsize or len(batch) == maxargs):
+            yield batch
+            batch = []
+            size = fixedsize
+        batch.append(arg)
+        size += n
+    if batch:
+        yield batch
 
-def _execstyle(program):
-    return _of(program, program.path, program.textmode, program.cwd, program.args, program.kwargs, _execmode, program.ttl)
+def _xargsmode(workers, maxsize, maxargs, program, *args, **kwargs):
+    from concurrent.futures import ThreadPoolExecutor
+    cmd, kwargs, xform = program._transform((), kwargs, _returncodecheck)
+    check = kwargs.pop('check')
+    env = kwargs['env']
+    fixedsize = sum(map(_argsize, cmd)) + sum(_argsize(f"{k}={v}") for k, v in (os.environ if env is None else env).items())
+    if maxsize is None:
+        maxsize = os.sysconf('SC_ARG_MAX') - argmaxheadroom
+    batches = _batches(fixedsize, [arg if isinstance(arg, bytes) else str(arg) for arg in args], maxsize, maxargs)
+    run = lambda batch: _run([*cmd, *batch], **kwargs)
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(run, batches))
+    else:
+        results = list(map(run, batches))
+    empty = '' if kwargs['universal_newlines'] else b''
+    stdout, stderr = (None if kwargs.get(name) != subprocess.PIPE else empty.join(getattr(r, name) for r in results) for name in ['stdout', 'stderr'])
+    returncode = next((r.returncode for r in results if r.returncode), 0)
+    if check and returncode:
+        raise BatchError(returncode, cmd, stdout, stderr, results)
+    return xform(BatchedProcess(cmd, returncode, stdout, stderr, results))
 
 def _execmode(program, *args, **kwargs): # XXX: Flush stdout (and stderr) first?
     supportedkeys = {'cwd', 'env'}
     keys = kwargs.keys()
     if not keys <= supportedkeys:
         raise Exception("Unsupported keywords: %s" % (keys - supportedkeys))
-    cmd, kwargs, _ = program._transform(args, kwargs, lambda: None)
+    cmd, kwargs, _ = program._transform(args, kwargs, _nocheck)
     cwd, env = (kwargs[k] for k in ['cwd', 'env'])
+    for tracer in list(tracers):
+        tracer(Trace(cmd, cwd))
     if cwd is None:
         os.execvpe(cmd[0], cmd, env)
     # First replace this program so that failure can't be caught after chdir:
@@ -254,15 +1570,27 @@ def _execmode(program, *args, **kwargs): # XXX: Flush stdout (and stderr) first?
     os.execve(precmd[0], precmd, os.environ if env is None else env)
 
 bg = partial = object()
-tee = object()
+aio = object()
+forkserver = object()
+imap = object()
+lines = object()
+spawn = object()
 styles = {
+    aio: ModeStyle(_aiomode),
     bool: _boolstyle,
-    exec: _execstyle,
+    exec: ModeStyle(_execmode),
+    forkserver: _forkserverstyle,
     functools.partial: _partialstyle,
+    imap: ModeStyle(_imapmode),
+    lines: ModeStyle(_linesmode),
+    mmap: ModeStyle(_mmapmode),
     json: _stdoutstyle(json.loads),
+    ndjson: ndjson(),
     NOEOL: _stdoutstyle(NOEOL),
     ONELINE: _stdoutstyle(ONELINE),
     partial: _partialstyle,
     print: _stdoutstyle(None),
-    tee: _teestyle,
+    spawn: _popenstyle(SpawnPopen),
+    tee: tee(),
+    xargs: xargs(),
 }
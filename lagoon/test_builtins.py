@@ -0,0 +1,95 @@
+# Copyright 2018, 2019, 2020 Andrzej Cichocki
+
+# This file is part of lagoon.
+#
+# lagoon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lagoon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import program
+from .builtins import builtinpopen, disable, enable, registry
+from .program import bg, lines, partial, Program, refresh, tee
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import shutil, subprocess
+
+class TestConformance(TestCase):
+
+    cases = dict(
+        basename = [['/a/b.txt'], ['/a/b.txt', '.txt'], ['b.txt', 'b.txt'], ['/a/b/'], ['///'], [''], ['a//'], ['/a/b', ''], ['x', 'y', 'z'], [], ['-a', 'x']],
+        cat = [['file'], ['file', 'file'], ['nosuch'], ['file', 'nosuch', 'file'], ['.'], [], ['-'], ['-', 'file'], ['-n', 'file']],
+        echo = [[], ['woo'], ['woo', 'yay'], ['-n', 'woo'], ['-nE', 'a\\tb'], ['-e', 'a\\tb'], ['--', 'x'], ['-x'], ['--help', 'x'], [' spaced ', '']],
+        false = [[], ['x'], ['--help', 'x']],
+        pwd = [[], ['-P']],
+        true = [[], ['x'], ['--help', 'x']],
+    )
+
+    def test_conformance(self):
+        with TemporaryDirectory() as d:
+            d = Path(d)
+            (d / 'file').write_bytes(b'woo\nyay')
+            for name, argsets in self.cases.items():
+                real = Program.binary(shutil.which(name)).cd(d)[partial](check = False, input = b'in\n')
+                builtin = real[partial](popen = builtinpopen)
+                for args in argsets:
+                    with self.subTest(name = name, args = args):
+                        expected = real(*args)
+                        actual = builtin(*args)
+                        self.assertEqual((expected.returncode, expected.stdout), (actual.returncode, actual.stdout))
+
+    def test_styles(self):
+        echo = Program.text(shutil.which('echo'))[partial](popen = builtinpopen)
+        with patch('subprocess._fork_exec', side_effect = AssertionError), patch('os.posix_spawn', side_effect = AssertionError):
+            self.assertEqual('woo\n', echo('woo'))
+            self.assertEqual('woo\n', echo[tee(lambda _: None)]('woo'))
+            self.assertEqual(['a\n', 'b\n'], list(echo[lines]('a\nb')))
+            with echo[bg]('woo') as stdout:
+                self.assertEqual('woo\n', stdout.read())
+            self.assertTrue(Program.text(shutil.which('true'))[partial](popen = builtinpopen)[print, bool]())
+            self.assertEqual('in', Program.text(shutil.which('cat'))[partial](popen = builtinpopen)(input = 'in'))
+
+    def test_registry(self):
+        self.assertEqual({'basename', 'cat', 'echo', 'false', 'pwd', 'true'}, registry.keys())
+
+    def test_enable(self):
+        import lagoon
+        enable('echo')
+        try:
+            self.assertEqual('woo\n', lagoon.echo('woo'))
+            self.assertIs(lagoon.echo.kwargs['popen'], lagoon.binary.echo.kwargs['popen'])
+            self.assertNotIn('popen', lagoon.true.kwargs)
+        finally:
+            disable()
+        self.assertNotIn('popen', lagoon.echo.kwargs)
+
+    def test_fallback(self):
+        import lagoon
+        launched = []
+        def popen(args, **kwargs):
+            launched.append(args)
+            return subprocess.Popen(args, **kwargs)
+        program.inprocess['echo'] = popen
+        try:
+            enable('echo')
+            enable('echo')
+            with patch('subprocess._fork_exec', side_effect = AssertionError), patch('os.posix_spawn', side_effect = AssertionError):
+                self.assertEqual('woo\n', lagoon.echo('woo'))
+            self.assertEqual([], launched)
+            self.assertEqual('a\tb\n', lagoon.echo('-e', 'a\\tb')) # Unsupported.
+            self.assertEqual([[lagoon.echo.path, '-e', 'a\\tb']], launched)
+            disable()
+            self.assertIs(popen, program.inprocess['echo'])
+        finally:
+            program.inprocess.clear()
+            refresh()
@@ -15,34 +15,221 @@
 # You should have received a copy of the GNU General Public License
 # along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
 
-from .program import Program
-from types import SimpleNamespace
+from .program import _argsize, _batches, delimited, InProcessPopen, partial, PathIndex, Program, Tail, tee
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event
+from types import ModuleType
 from unittest import TestCase
+from unittest.mock import patch
+import gc, io, os, subprocess, time, weakref
 
 class TestProgram(TestCase):
 
     def test_importable(self):
-        t = SimpleNamespace()
-        b = SimpleNamespace()
-        Program._scan(t, b, {
-            'foo': '/foo',
-            'from': '/from',
-            'foo-bar': '/foo-bar',
-            'g++': '/g++',
-            'x++': '/x++',
-            'x..': '/x..',
-            'woo_yay': '/woo_yay',
-            'woo-yay': '/woo-yay',
-        })
-        for m in t, b:
-            self.assertEqual(['foo', 'from', 'foo-bar', 'foo_bar', 'g++', 'g__', 'x++', 'x..', 'woo_yay', 'woo-yay'], list(m.__dict__))
-            self.assertEqual('/foo', m.foo.path)
-            self.assertEqual('/from', getattr(m, 'from').path)
-            self.assertEqual('/foo-bar', getattr(m, 'foo-bar').path)
-            self.assertEqual('/foo-bar', m.foo_bar.path)
-            self.assertEqual('/g++', getattr(m, 'g++').path)
-            self.assertEqual('/g++', m.g__.path)
-            self.assertEqual('/x++', getattr(m, 'x++').path)
-            self.assertEqual('/x..', getattr(m, 'x..').path)
-            self.assertEqual('/woo_yay', m.woo_yay.path)
-            self.assertEqual('/woo-yay', getattr(m, 'woo-yay').path)
+        with TemporaryDirectory() as d1, TemporaryDirectory() as d2:
+            for name in 'foo', 'from', 'foo-bar', 'g++', 'x++', 'x..', 'woo_yay', 'woo-yay':
+                Path(d1, name).touch()
+            Path(d2, 'foo').touch()
+            Path(d2, 'a.b').touch()
+            index = PathIndex([d1, d2])
+            t = ModuleType('t')
+            b = ModuleType('b')
+            Program._scan(t, b, index)
+            for m in t, b:
+                self.assertEqual(f"{d1}/foo", m.foo.path)
+                self.assertEqual(f"{d1}/from", getattr(m, 'from').path)
+                self.assertEqual(f"{d1}/foo-bar", getattr(m, 'foo-bar').path)
+                self.assertEqual(f"{d1}/g++", getattr(m, 'g++').path)
+                self.assertEqual(f"{d1}/x++", getattr(m, 'x++').path)
+                self.assertEqual(f"{d1}/x..", getattr(m, 'x..').path)
+                self.assertEqual(f"{d1}/woo_yay", m.woo_yay.path)
+                self.assertEqual(f"{d1}/woo-yay", getattr(m, 'woo-yay').path)
+            self.assertIs(None, index.programs) # No listing needed so far.
+            for m in t, b:
+                self.assertEqual(f"{d1}/foo-bar", m.foo_bar.path)
+                self.assertEqual(f"{d1}/g++", m.g__.path)
+                self.assertEqual(f"{d2}/a.b", m.a_b.path)
+                with self.assertRaises(AttributeError):
+                    m.x__
+                with self.assertRaises(AttributeError):
+                    m.nosuchprogram
+                with self.assertRaises(AttributeError):
+                    m.__wrapped__
+            self.assertIsNot(None, index.programs)
+            self.assertIs(t.foo, t.foo)
+            self.assertIsNot(t.foo, b.foo)
+
+class TestPathIndex(TestCase):
+
+    def _age(self, d, secs):
+        t = time.time() - secs
+        os.utime(d, (t, t))
+
+    def test_cache(self):
+        with TemporaryDirectory() as d1, TemporaryDirectory() as d2, TemporaryDirectory() as cachedir:
+            cachepath = Path(cachedir, 'pathindex')
+            Path(d1, 'foo').touch()
+            Path(d2, 'bar-x').touch()
+            self._age(d1, 10)
+            self._age(d2, 10)
+            index = PathIndex([d1, d2], cachepath)
+            with patch('os.listdir', side_effect = AssertionError): # Exact names are always probed.
+                self.assertEqual(f"{d1}/foo", index.resolve('foo'))
+            self.assertFalse(cachepath.exists())
+            self.assertIs(None, index.resolve('no_such_alias'))
+            self.assertTrue(cachepath.exists())
+            with patch('os.listdir', side_effect = AssertionError):
+                index = PathIndex([d1, d2], cachepath)
+                self.assertEqual(f"{d2}/bar-x", index.resolve('bar_x'))
+                self.assertIs(None, index.resolve('baz_y'))
+            Path(d2, 'baz-y').touch()
+            self._age(d2, 5)
+            index = PathIndex([d1, d2], cachepath)
+            self.assertEqual(f"{d2}/baz-y", index.resolve('baz_y'))
+            with patch('os.listdir', side_effect = AssertionError):
+                index = PathIndex([d1, d2], cachepath)
+                self.assertEqual(f"{d2}/baz-y", index.resolve('baz_y'))
+
+    def test_racy(self):
+        with TemporaryDirectory() as d, TemporaryDirectory() as cachedir:
+            cachepath = Path(cachedir, 'pathindex')
+            Path(d, 'foo').touch()
+            self.assertEqual(f"{d}", PathIndex([d], cachepath)._allprograms()['foo'])
+            self.assertFalse(cachepath.exists())
+
+    def test_unreadable(self):
+        with TemporaryDirectory() as d, TemporaryDirectory() as cachedir:
+            cachepath = Path(cachedir, 'pathindex')
+            cachepath.write_bytes(b'\x80garbage')
+            Path(d, 'foo').touch()
+            with patch('os.listdir', side_effect = AssertionError):
+                self.assertEqual(f"{d}/foo", PathIndex([d], cachepath).resolve('foo'))
+
+    def test_refresh(self):
+        with TemporaryDirectory() as d1, TemporaryDirectory() as d2, TemporaryDirectory() as cachedir:
+            Path(d1, 'foo').touch()
+            index = PathIndex([d1], Path(cachedir, 'pathindex'))
+            self.assertIs(None, index.resolve('bar'))
+            Path(d2, 'bar').touch()
+            self.assertIs(None, index.resolve('bar'))
+            index.refresh([d1, d2])
+            self.assertEqual(f"{d2}/bar", index.resolve('bar'))
+
+class TestTail(TestCase):
+
+    def _tail(self, chunks, size, lines):
+        tail = Tail(size, lines)
+        for chunk in chunks:
+            tail.append(chunk)
+        return tail.value(chunks[0][:0])
+
+    def test_works(self):
+        for chunks in ['a\nbb\nccc\n'], ['a\n', 'bb\n', 'ccc\n'], list('a\nbb\nccc\n'), [b'a\nb', b'b\nccc\n']:
+            empty = chunks[0][:0]
+            text = empty.join(chunks)
+            self.assertEqual(text, self._tail(chunks, None, None))
+            self.assertEqual(text[-4:], self._tail(chunks, 4, None))
+            self.assertEqual(text, self._tail(chunks, 100, None))
+            self.assertEqual(empty, self._tail(chunks, 0, None))
+            self.assertEqual(text[-4:], self._tail(chunks, None, 1))
+            self.assertEqual(text[-7:], self._tail(chunks, None, 2))
+            self.assertEqual(text, self._tail(chunks, None, 3))
+            self.assertEqual(text, self._tail(chunks, None, 4))
+            self.assertEqual(empty, self._tail(chunks, None, 0))
+            self.assertEqual(text[-3:], self._tail(chunks, 3, 2))
+            self.assertEqual(text[-4:], self._tail(chunks, 5, 1))
+
+    def test_partialline(self):
+        self.assertEqual('ccc', self._tail(['a\nbb\nccc'], None, 1))
+        self.assertEqual('bb\nccc', self._tail(['a\nb', 'b\nc', 'cc'], None, 2))
+
+class TestIntern(TestCase):
+
+    def test_works(self):
+        echo = Program.text('/bin/echo')
+        self.assertIs(echo.woo._n, echo.woo._n)
+        self.assertIs(echo[print, bool], echo[print, bool])
+        self.assertIs(echo.cd('/tmp').woo, echo.cd('/tmp').woo)
+        self.assertIsNot(echo.woo, echo.yay)
+        self.assertIsNot(echo.cd('/tmp'), echo.cd('/usr'))
+        self.assertEqual(('woo', '-n'), echo.woo._n.args)
+        with self.assertRaises(AttributeError):
+            echo.woo.x = 1
+        self.assertEqual(0, Program.__dictoffset__)
+
+    def test_parameterised(self):
+        echo = Program.text('/bin/echo')
+        sink = io.StringIO()
+        ref = weakref.ref(sink)
+        self.assertEqual('woo\n', echo[tee(sink)]('woo'))
+        del sink
+        gc.collect()
+        self.assertIs(None, ref())
+
+    def test_resource(self):
+        cat = Program.text('/bin/cat')
+        f = io.StringIO()
+        ref = weakref.ref(f)
+        self.assertIsNot(cat[partial](stdout = f).woo, cat[partial](stdout = f).woo)
+        self.assertIsNot(cat[partial](stdout = f)[print], cat[partial](stdout = f)[print])
+        del f
+        gc.collect()
+        self.assertIs(None, ref())
+
+class TestDelimited(TestCase):
+
+    class Trickle(io.RawIOBase):
+
+        def __init__(self, data):
+            self.data = data
+
+        def readable(self):
+            return True
+
+        def readinto(self, b):
+            n = min(len(self.data), len(b), 2)
+            b[:n] = self.data[:n]
+            self.data = self.data[n:]
+            return n
+
+    def test_straddle(self):
+        stdout = io.BufferedReader(self.Trickle(b'woo<<>>y<a>y<<>><<>>x'))
+        read = delimited(b'<<>>')
+        self.assertEqual(b'woo', read(stdout))
+        self.assertEqual(b'y<a>y', read(stdout))
+        self.assertEqual(b'', read(stdout))
+        with self.assertRaises(EOFError):
+            read(stdout)
+
+class TestBatches(TestCase):
+
+    def test_works(self):
+        self.assertEqual([], list(_batches(100, [], 200, None)))
+        self.assertEqual([['a' * 1000]], list(_batches(100, ['a' * 1000], 200, None))) # Too big but best effort.
+        n = _argsize('aa')
+        self.assertEqual([['aa', 'aa'], ['aa', 'aa'], ['aa']], list(_batches(100, ['aa'] * 5, 100 + 2 * n, None)))
+        self.assertEqual([['aa', 'aa', 'aa'], ['aa', 'aa']], list(_batches(100, ['aa'] * 5, 100 + 3 * n + n - 1, None)))
+        self.assertEqual([['aa'], ['aa'], ['aa']], list(_batches(0, ['aa'] * 3, 100, 1)))
+
+class TestInProcessPopen(TestCase):
+
+    def test_concurrent(self):
+        release = Event()
+        def outcome(args, cwd, env, input, merged, kwargs):
+            release.wait() # Like a child reading its inherited stdin.
+            return 0, b'woo', b''
+        with InProcessPopen(outcome, ['x'], stdout = subprocess.PIPE) as p:
+            self.assertIs(None, p.poll())
+            release.set()
+            self.assertEqual(b'woo', p.stdout.read())
+        self.assertEqual(0, p.returncode)
+
+    def test_error(self):
+        class X(Exception): pass
+        def outcome(*args):
+            raise X
+        p = InProcessPopen(outcome, ['x'])
+        with self.assertRaises(X):
+            p.wait()
+        self.assertEqual(1, p.wait())
@@ -15,11 +15,14 @@
 # You should have received a copy of the GNU General Public License
 # along with lagoon.  If not, see <http://www.gnu.org/licenses/>.
 
-from .util import atomic, mapcm, unmangle
+from .util import atomic, mapcm, transfer, unmangle
 from diapyr.util import singleton
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, TemporaryFile
+from threading import Thread
 from unittest import TestCase
+from unittest.mock import patch
+import errno, os
 
 @singleton
 class Unmangle:
@@ -101,3 +104,65 @@ class TestAtomic(TestCase):
                 raise X
             self.assertFalse(q.exists())
             self.assertFalse(p.exists())
+
+class TestTransfer(TestCase):
+
+    data = bytes(range(256)) * 1000
+
+    def _source(self):
+        f = TemporaryFile()
+        f.write(self.data)
+        f.seek(0)
+        return f
+
+    def _pipe(self, src, count = None):
+        r, w = os.pipe()
+        chunks = []
+        def drain():
+            with open(r, 'rb') as f:
+                chunks.append(f.read())
+        t = Thread(target = drain)
+        t.start()
+        try:
+            n = transfer(src, w, count)
+        finally:
+            os.close(w)
+            t.join()
+        return n, chunks[0]
+
+    @patch('lagoon.util._bufferedcopy', side_effect = AssertionError)
+    def test_files(self, _):
+        with self._source() as src, TemporaryFile() as dst:
+            src.seek(1000)
+            dst.write(b'x')
+            self.assertEqual(len(self.data) - 1000, transfer(src, dst))
+            dst.seek(0)
+            self.assertEqual(b'x' + self.data[1000:], dst.read())
+        with self._source() as src, TemporaryFile() as dst:
+            self.assertEqual(100, transfer(src, dst, 100))
+            self.assertEqual(self.data[100:200], src.read(100))
+            dst.seek(0)
+            self.assertEqual(self.data[:100], dst.read())
+
+    @patch('lagoon.util._bufferedcopy', side_effect = AssertionError)
+    def test_pipes(self, _):
+        with self._source() as src:
+            self.assertEqual((len(self.data), self.data), self._pipe(src))
+        with self._source() as src:
+            r, w = os.pipe()
+            with open(r, 'rb') as pipe, TemporaryFile() as dst:
+                Thread(target = lambda: (transfer(src, w), os.close(w))).start()
+                self.assertEqual(len(self.data), transfer(pipe, dst))
+                dst.seek(0)
+                self.assertEqual(self.data, dst.read())
+
+    def test_fallback(self):
+        def unsupported(*args):
+            raise OSError(errno.EINVAL, 'unsupported')
+        with patch.object(os, 'copy_file_range', unsupported), patch.object(os, 'splice', unsupported), patch.object(os, 'sendfile', unsupported):
+            with self._source() as src, TemporaryFile() as dst:
+                self.assertEqual(len(self.data), transfer(src, dst))
+                dst.seek(0)
+                self.assertEqual(self.data, dst.read())
+            with self._source() as src:
+                self.assertEqual((1000, self.data[:1000]), self._pipe(src, 1000))
@@ -17,13 +17,53 @@
 
 from collections import defaultdict
 from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from threading import local
-import os, re, sys
+import errno, functools, os, re, stat, subprocess, sys
 
 mangled = re.compile('_.*(__.*[^_]_?)')
 PYTHONPATH = os.pathsep.join(sys.path[1:]) # XXX: Include first entry?
+NORMAL = lambda o: o.exception() is None
+ABRUPT = lambda o: o.exception() is not None
+ALWAYS = lambda o: True
+NEVER = lambda o: False
+blocksize = 0x1000000
+bufsize = 0x10000
+unsupported = {errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.EXDEV}
+
+class NormalOutcome:
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def result(self):
+        return self.obj
+
+    def exception(self):
+        pass
+
+class AbruptOutcome:
+
+    def __init__(self, e):
+        self.e = e
+
+    def result(self):
+        raise self.e
+
+    def exception(self):
+        return self.e
+
+def waitstatus(returncode):
+    'Inverse of what Popen does to a wait status.'
+    return -returncode if returncode < 0 else returncode << 8
+
+@functools.lru_cache()
+def executechild():
+    'Signature of the private Popen._execute_child, for binding its args by name. Computed on first use as inspect is slow to import.'
+    import inspect
+    return inspect.signature(subprocess.Popen._execute_child)
 
 def unmangle(name):
     m = mangled.fullmatch(name)
@@ -56,6 +96,20 @@ class threadlocalproperty:
     def __set__(self, obj, value):
         self._lookup()[obj] = value
 
+class contextlocalproperty:
+    'Like threadlocalproperty but each asyncio task sees its own values.'
+
+    def __init__(self, defaultfactory):
+        self.var = ContextVar(type(self).__name__, default = {})
+        self.defaultfactory = defaultfactory
+
+    def __get__(self, obj, objtype):
+        lookup = self.var.get()
+        return lookup[obj] if obj in lookup else self.defaultfactory()
+
+    def __set__(self, obj, value):
+        self.var.set({**self.var.get(), obj: value}) # Copy as the dict may be visible to other contexts.
+
 @contextmanager
 def onerror(f):
     try:
@@ -71,3 +125,46 @@ def mapcm(f, obj):
 
 def stripansi(text):
     return re.sub('\x1b\\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]', '', text) # XXX: Duplicated code?
+
+def transfer(src, dst, count = None):
+    '''Copy count bytes, or until EOF, from src to dst, which may be fds or file objects, starting at their current positions.
+    The data stays in the kernel via copy_file_range, splice or sendfile where possible, otherwise it goes through a small buffer.
+    A src file object must not have read ahead into its own buffer, as is the case for a fresh bg stdout. Return the number of bytes copied.'''
+    if not isinstance(dst, int):
+        dst.flush()
+        dst = dst.fileno()
+    if not isinstance(src, int):
+        src = src.fileno()
+    copied = 0
+    def copyall(copy):
+        nonlocal copied
+        while count is None or copied < count:
+            n = copy(src, dst, blocksize if count is None else min(blocksize, count - copied))
+            if not n:
+                break
+            copied += n
+    for copy in _zerocopies(src, dst):
+        try:
+            copyall(copy)
+            return copied
+        except OSError as e:
+            if e.errno not in unsupported:
+                raise
+    copyall(_bufferedcopy)
+    return copied
+
+def _zerocopies(src, dst):
+    srcmode, dstmode = (os.fstat(fd).st_mode for fd in [src, dst])
+    if stat.S_ISREG(srcmode) and stat.S_ISREG(dstmode) and hasattr(os, 'copy_file_range'):
+        yield lambda src, dst, n: os.copy_file_range(src, dst, n)
+    if (stat.S_ISFIFO(srcmode) or stat.S_ISFIFO(dstmode)) and hasattr(os, 'splice'):
+        yield lambda src, dst, n: os.splice(src, dst, n)
+    if stat.S_ISREG(srcmode) and hasattr(os, 'sendfile'):
+        yield lambda src, dst, n: os.sendfile(dst, src, None, n)
+
+def _bufferedcopy(src, dst, n):
+    view = memoryview(os.read(src, min(n, bufsize)))
+    n = len(view)
+    while view:
+        view = view[os.write(dst, view):]
+    return n
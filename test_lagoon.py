@@ -18,15 +18,16 @@
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack, redirect_stdout
 from io import StringIO
-from lagoon.program import bg, NOEOL, ONELINE, partial, Program, tee
-from lagoon.util import PYTHONPATH
+from lagoon.program import Aggregator, aio, BatchError, bg, capture, coprocess, delimited, forkserver, imap, lengthprefixed, lines, memo, ndjson, NOEOL, ONELINE, partial, ProcessGroup, Program, sentinel, spawn, tee, tofile, tracers, tracing, xargs
+from lagoon.util import PYTHONPATH, transfer
 from pathlib import Path
-from signal import SIGTERM
+from signal import SIGKILL, SIGPIPE, SIGTERM
 from tempfile import TemporaryDirectory, TemporaryFile
-from threading import Event
+from threading import Event, Thread
 from unittest import TestCase
+from unittest.mock import patch
 from uuid import uuid4
-import os, stat, subprocess, sys
+import asyncio, json, logging, mmap, os, stat, subprocess, sys, time
 
 interpret = Program.text(sys.executable)[partial](env = dict(PYTHONPATH = PYTHONPATH))._c
 
@@ -41,6 +42,26 @@ class TestLagoon(TestCase):
             del thisisnotanexecutable
         self.assertRaises(ImportError, imp)
 
+    def test_refresh(self):
+        from lagoon.program import refresh
+        def imp():
+            from lagoon import testlagoonrefresh
+            return testlagoonrefresh
+        path = os.environ['PATH']
+        with TemporaryDirectory() as d:
+            p = Path(d, 'testlagoonrefresh')
+            p.write_text('#!/bin/sh\necho refreshed\n')
+            p.chmod(p.stat().st_mode | stat.S_IXUSR)
+            os.environ['PATH'] = os.pathsep.join([d, path])
+            try:
+                self.assertRaises(ImportError, imp)
+                refresh()
+                self.assertEqual('refreshed\n', imp()())
+            finally:
+                os.environ['PATH'] = path
+                refresh()
+        self.assertRaises(ImportError, imp)
+
     def test_false(self):
         from lagoon import false
         false(check = False)
@@ -290,6 +311,42 @@ class TestLagoon(TestCase):
             result = echo[tee]('woo')
         self.assertEqual('woo\n', result)
         self.assertEqual('woo\n', f.getvalue())
+        self.assertEqual('woo\n', echo[tee(StringIO())]('woo', universal_newlines = True))
+        for key in str, 'tee', None:
+            with self.assertRaises(KeyError):
+                echo[key]
+
+    def test_teesinks(self):
+        from lagoon import seq
+        from lagoon.binary import echo
+        f = StringIO()
+        chunks = []
+        logger = logging.getLogger(f"{__name__}.test_teesinks")
+        with self.assertLogs(logger) as cm:
+            self.assertEqual('1\n2\n3\n', seq[tee(f, chunks.append, logger)](3))
+        self.assertEqual('1\n2\n3\n', f.getvalue())
+        self.assertEqual('1\n2\n3\n', ''.join(chunks))
+        self.assertEqual(['1', '2', '3'], [r.getMessage() for r in cm.records])
+        with TemporaryFile() as f:
+            self.assertEqual(b'woo\n', echo[tee(f)]('woo'))
+            f.seek(0)
+            self.assertEqual(b'woo\n', f.read())
+        text = ''.join(f"{i}\n" for i in range(1, 100001))
+        f = StringIO()
+        self.assertEqual('99999\n100000\n', seq[tee(f, taillines = 2)](100000))
+        self.assertEqual(text, f.getvalue())
+        self.assertEqual('0\n', seq[tee(StringIO(), tailsize = 2)](100000))
+        self.assertEqual('\n', seq[tee(StringIO(), tailsize = 2, taillines = 2)](100000)[-1:])
+        self.assertEqual('100000\n', seq[tee(StringIO(), tailsize = 100, taillines = 1)](100000))
+        self.assertEqual('', seq[tee(StringIO(), taillines = 0)](100000))
+        self.assertEqual(text, seq[tee(StringIO(), taillines = 100000)](100000))
+        with self.assertRaises(subprocess.CalledProcessError):
+            Program.text(sys.executable)._c[tee(StringIO())]('print(1)\nexit(1)')
+        class X(Exception): pass
+        def fail(data):
+            raise X
+        with self.assertRaises(X):
+            seq[tee(fail)](100000)
 
     def test_stdoutclash(self):
         from lagoon import echo
@@ -453,3 +510,617 @@ class TestLagoon(TestCase):
             self.assertIs(False, w())
         with true[bool] as w:
             self.assertIs(True, w())
+
+    def test_aio(self):
+        from lagoon import echo, env, false, pwd, true
+        from lagoon.binary import echo as echob
+        async def main():
+            self.assertEqual('woo\n', await echo[aio]('woo'))
+            self.assertEqual(b'woo\n', await echob[aio]('woo'))
+            self.assertEqual('woo', await echo[aio, NOEOL]('woo'))
+            self.assertEqual('woo', await echo[aio, ONELINE]('woo'))
+            self.assertEqual(dict(x = 1), await echo[aio, json]('{"x": 1}'))
+            self.assertEqual('x\ny\n', await Program.text(sys.executable)[aio]._c("import sys\nsys.stdout.buffer.write(b'x\\r\\ny\\r')"))
+            self.assertEqual('/tmp\n', await pwd[aio](cwd = '/tmp'))
+            self.assertEqual('/usr/bin\n', await pwd.cd('/usr')[aio](cwd = 'bin'))
+            self.assertIn('TestLagoon=aio', (await env[aio](env = dict(TestLagoon = 'aio'))).splitlines())
+            self.assertEqual('woo', await Program.text(sys.executable)[aio, NOEOL]._c('print(input())', input = 'woo\n'))
+            with self.assertRaises(subprocess.CalledProcessError):
+                await false[aio]()
+            self.assertIs(False, await false[print, bool, aio]())
+            self.assertIs(True, await true[print, bool, aio]())
+            self.assertEqual(1, (await false[aio](check = False)).returncode)
+            results = await asyncio.gather(*(echo[aio](i) for i in range(10)))
+            self.assertEqual([f"{i}\n" for i in range(10)], results)
+        asyncio.run(main())
+
+    def test_aiobg(self):
+        from lagoon import echo, false, sleep, true
+        async def main():
+            async with echo[bg]('woo') as stdout:
+                self.assertEqual(b'woo\n', await stdout.read())
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                async with false:
+                    pass
+            self.assertEqual(1, cm.exception.returncode)
+            async with false[print, bool] as wait:
+                self.assertIs(False, await wait())
+            async with true[print, bool] as wait:
+                self.assertIs(True, await wait())
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                async with sleep.inf[bg](stdout = None, aux = 'terminate') as terminate:
+                    terminate()
+            self.assertEqual(-SIGTERM, cm.exception.returncode)
+            async with echo.woo as stdout1, echo.woo as stdout2: # Same object nested.
+                self.assertEqual(b'woo\n', await stdout2.read())
+                self.assertEqual(b'woo\n', await stdout1.read())
+            async def task(word):
+                async with echo[bg](word) as stdout:
+                    await asyncio.sleep(.1)
+                    return await stdout.read()
+            self.assertEqual([b'woo\n', b'yay\n'], await asyncio.gather(task('woo'), task('yay')))
+        asyncio.run(main())
+
+    def test_imap(self):
+        from lagoon import echo, sh
+        results = list(echo[imap](range(20), workers = 3))
+        self.assertEqual([(i,) for i in range(20)], [args for args, _ in results])
+        self.assertEqual([f"{i}\n" for i in range(20)], [f.result() for _, f in results])
+        self.assertEqual(['a b\n'], [f.result() for _, f in echo[imap]([('a', 'b')])])
+        self.assertEqual(['woo'], [f.result() for _, f in echo[imap]([['woo']], stdout = ONELINE)])
+        # Results arrive as they complete:
+        sleep = sh._c[partial]('sleep $0; echo $0')
+        self.assertEqual([(0,), (.5,)], [args for args, _ in sleep[imap]([.5, 0], workers = 2, ordered = False)])
+        self.assertEqual([(.5,), (0,)], [args for args, _ in sleep[imap]([.5, 0], workers = 2)])
+        # Failures don't stop the others:
+        fail = sh._c[partial]('exit $0')
+        futures = [f for _, f in fail[imap]([0, 1, 0, 2, 0], workers = 2)]
+        self.assertEqual([None, 1, None, 2, None], [None if f.exception() is None else f.exception().returncode for f in futures])
+        self.assertTrue(all(isinstance(f.exception(), subprocess.CalledProcessError) for f in futures[1::2]))
+        self.assertEqual([True, False, True, False, True], [f.result() for _, f in fail[print, bool, imap]([0, 1, 0, 2, 0])])
+
+    def test_imapfailfast(self):
+        from lagoon import sh
+        fail = sh._c[partial]('sleep $0; exit $1')
+        futures = [f for _, f in fail[imap]([(0, 1), (.5, 0), *[(0, 0)] * 100], workers = 2, failfast = True)]
+        self.assertEqual(1, futures[0].exception().returncode)
+        self.assertLess(len(futures), 102)
+        self.assertTrue(any(f.cancelled() for f in futures))
+        self.assertTrue(all(f.cancelled() or f.exception() is None for f in futures[1:]))
+        futures = [f for _, f in fail[imap]([(1, 0), (0, 1), (0, 0), (0, 0), (0, 0)], workers = 2, failfast = True)] # Ordered.
+        self.assertEqual([None, 1], [None if f.exception() is None else f.exception().returncode for f in futures[:2]])
+        self.assertEqual([True, True], [f.cancelled() for f in futures[2:]]) # Cancelled while the first was still running, and no more submitted.
+
+    def test_pipeline(self):
+        from lagoon import cat, echo, false, gzip, head, sh, tr, true, wc, yes
+        from lagoon.binary import gzip as gzipb
+        self.assertEqual('WOO\n', (echo.woo | tr[partial]('a-z', 'A-Z'))())
+        self.assertEqual('WOO', (echo.woo | tr[partial]('a-z', 'A-Z') | cat[NOEOL])())
+        self.assertEqual('woo\n', (echo.woo | gzipb._c | gzip._d)())
+        self.assertEqual('3', (yes[partial](check = False) | head._n[partial](3) | wc._l[NOEOL])())
+        with self.assertRaises(subprocess.CalledProcessError) as cm: # Like pipefail.
+            (yes | head._n[partial](3))()
+        self.assertEqual(-SIGPIPE, cm.exception.returncode)
+        self.assertEqual(f"{echo.path} woo | {tr.path} a-z A-Z", str(echo.woo | tr[partial]('a-z', 'A-Z')))
+        self.assertEqual('x\n', (echo.x | cat)(stderr = subprocess.PIPE).stdout)
+        with TemporaryFile('w+') as f:
+            self.assertIs(None, (echo.woo | cat)(stdout = f))
+            f.seek(0)
+            self.assertEqual('woo\n', f.read())
+        # Every stage is checked:
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            (false | cat)()
+        self.assertEqual([false.path], cm.exception.cmd)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            (echo.woo | false)()
+        self.assertEqual([false.path], cm.exception.cmd)
+        # Rightmost failure wins:
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            (sh._c[partial]('exit 1') | sh._c[partial]('exit 2') | cat)()
+        self.assertEqual(2, cm.exception.returncode)
+        self.assertEqual('', (false[partial](check = False) | cat)())
+        self.assertIs(False, (true | false[print, bool])())
+        self.assertEqual(1, (true | false)(check = False).returncode)
+        self.assertEqual('ABC', (cat[partial](input = 'abc') | tr[partial]('a-z', 'A-Z'))())
+        self.assertEqual('ABC', (cat[partial](input = b'abc') | cat | tr[partial]('a-z', 'A-Z'))())
+        with self.assertRaises(ValueError):
+            (cat | tr[partial]('a-z', 'A-Z'))(input = 'abc')
+        with self.assertRaises(ValueError):
+            (cat | tr[partial]('a-z', 'A-Z', input = 'abc'))()
+        with self.assertRaises(ValueError):
+            (echo.woo | cat[partial](input = 'abc') | cat)()
+        for mode in lines, tee(StringIO()), memo(5):
+            with self.assertRaises(ValueError):
+                (echo.woo | cat[mode])()
+            with self.assertRaises(ValueError):
+                (echo.woo[mode] | cat)()
+
+    def test_pipelinestderr(self):
+        from lagoon import cat, echo, python3
+        chatty = python3._c[partial]('import sys\nfor line in sys.stdin: sys.stderr.write(line * 1000)\nsys.stdout.write("ok")', stderr = subprocess.PIPE)
+        self.assertEqual('ok', (python3._c[partial]('for i in range(100): print(i)') | chatty | cat)())
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            (echo.woo | python3._c[partial]('import sys; sys.exit(sys.stdin.read().upper())', stderr = subprocess.PIPE) | cat)()
+        self.assertEqual(1, cm.exception.returncode)
+        self.assertIs(None, cm.exception.output)
+        self.assertEqual('WOO\n\n', cm.exception.stderr)
+
+    def test_lines(self):
+        from lagoon import false, seq, sh
+        from lagoon.binary import seq as seqb
+        self.assertEqual([f"{i}\n" for i in range(1, 4)], list(seq[lines](3)))
+        self.assertEqual(b''.join(f"{i}\n".encode() for i in range(1, 100001)), b''.join(seqb[lines](100000)))
+        self.assertEqual([], list(false[lines](check = False)))
+        with self.assertRaises(subprocess.CalledProcessError):
+            list(false[lines]())
+        with self.assertRaises(subprocess.CalledProcessError):
+            list(sh._c[lines]('echo woo; exit 1'))
+        # Stop early without error:
+        g = seq[lines]('inf')
+        self.assertEqual('1\n', next(g))
+        g.close()
+        # Checked on close if already finished:
+        g = sh._c[lines]('echo woo; exit 1')
+        self.assertEqual('woo\n', next(g))
+        time.sleep(.5)
+        with self.assertRaises(subprocess.CalledProcessError):
+            g.close()
+        # Not started until iterated:
+        g = Program.text(str(uuid4()))[lines]()
+        with self.assertRaises(FileNotFoundError):
+            next(g)
+
+    def test_spawn(self):
+        from lagoon import cat, echo, false, pwd
+        calls = []
+        def posix_spawn(*args, **kwargs):
+            calls.append(args[1])
+            return real(*args, **kwargs)
+        real = os.posix_spawn
+        with patch('os.posix_spawn', posix_spawn):
+            self.assertEqual('woo\n', echo[spawn]('woo'))
+            self.assertEqual([[echo.path, 'woo']], calls)
+            with echo[spawn, bg]('yay') as stdout:
+                self.assertEqual('yay\n', stdout.read())
+            self.assertEqual([echo.path, 'yay'], calls[-1])
+            with self.assertRaises(subprocess.CalledProcessError):
+                false[spawn]()
+            self.assertEqual('hmm', cat[spawn, NOEOL](input = 'hmm'))
+            self.assertEqual(4, len(calls))
+            # Fall back:
+            self.assertEqual('/tmp\n', pwd[spawn](cwd = '/tmp'))
+            echo[spawn, print]('woo', stdout = subprocess.DEVNULL, stderr = subprocess.STDOUT)
+            self.assertEqual(5, len(calls))
+            with TemporaryFile() as f:
+                echo[spawn]('woo', stdout = f, stderr = 1)
+            self.assertEqual(5, len(calls))
+            self.assertEqual('woo\n', Program.text('echo')[spawn]('woo'))
+            self.assertEqual(5, len(calls))
+
+    def test_compiled(self):
+        from lagoon import cat, diff, echo, env
+        woo = echo[partial]('woo')
+        self.assertEqual('woo 1\n', woo(1))
+        self.assertEqual(1, len(woo._compiled))
+        self.assertEqual('woo 2\n', woo(2))
+        self.assertEqual('woo 3', woo(3, stdout = NOEOL))
+        self.assertEqual(1, len(woo._compiled))
+        with woo[bg](4) as stdout:
+            self.assertEqual('woo 4\n', stdout.read())
+        # The env is still derived from os.environ at call time:
+        testenv = env[partial](env = dict(TestLagoon = 'x'))
+        self.assertIn('TestLagoon=x', testenv().splitlines())
+        os.environ['TestLagoonCompiled'] = 'y'
+        try:
+            self.assertIn('TestLagoonCompiled=y', testenv().splitlines())
+        finally:
+            del os.environ['TestLagoonCompiled']
+        self.assertNotIn('TestLagoonCompiled=y', testenv().splitlines())
+        # Readable call args aren't cached:
+        with TemporaryDirectory() as d:
+            p = Path(d, 'f')
+            p.write_text('woo\n')
+            with p.open() as f:
+                self.assertEqual('woo\n', cat(f))
+            with p.open() as f:
+                diff(p, f)
+            with p.open() as f:
+                diffp = diff[partial](f)
+                diffp(p)
+                with p.open() as g, self.assertRaises(ValueError):
+                    diffp(g)
+
+    def test_envoverlay(self):
+        from lagoon import env
+        partial1 = env[partial](env = dict(TestLagoon = 'x'))
+        partial2 = partial1[partial](env = dict(TestLagoonOther = 'y'))
+        overlay = partial1.kwargs['env']
+        self.assertIs(overlay, partial1[partial]('-0').kwargs['env']) # Shared.
+        self.assertIn('TestLagoon=x', partial1().splitlines())
+        materialised = overlay.materialise()
+        self.assertIs(materialised, overlay.materialise())
+        self.assertEqual({'TestLagoon=x', 'TestLagoonOther=y'}, {l for l in partial2().splitlines() if l.startswith('TestLagoon')})
+        os.environ['TestLagoonOther'] = 'z'
+        try:
+            self.assertIsNot(materialised, overlay.materialise())
+            self.assertEqual({'TestLagoon=x', 'TestLagoonOther=z'}, {l for l in partial1().splitlines() if l.startswith('TestLagoon')})
+            self.assertEqual({'TestLagoon=x', 'TestLagoonOther=y'}, {l for l in partial2().splitlines() if l.startswith('TestLagoon')})
+            self.assertEqual({'TestLagoon=x'}, {l for l in partial1(env = dict(TestLagoonOther = None)).splitlines() if l.startswith('TestLagoon')})
+        finally:
+            del os.environ['TestLagoonOther']
+        self.assertEqual({'TestLagoon=x'}, {l for l in partial1().splitlines() if l.startswith('TestLagoon')})
+        # Partial with None env:
+        self.assertIn('TestLagoon=w', env[partial](env = None)(env = dict(TestLagoon = 'w')).splitlines())
+        self.assertIn('TestLagoon=w', env[partial](env = None)[partial](env = dict(TestLagoon = 'w'))().splitlines())
+
+    def test_tracing(self):
+        from lagoon import echo, false, python3
+        traces = []
+        aggregator = Aggregator()
+        with tracing(traces.append), tracing(aggregator):
+            self.assertEqual('woo\n', echo('woo'))
+            with echo[bg]('yay') as stdout:
+                stdout.read()
+            self.assertEqual(1, false(check = False).returncode)
+            self.assertEqual('x' * 1000, python3[tee(lambda _: None)]('-c', "print('x' * 1000, end = '')"))
+            self.assertEqual(['a\n', 'b\n'], list(echo[lines]('a\nb')))
+            python3._c[print]('bytearray(50 << 20)')
+        self.assertEqual([], tracers)
+        echo('untraced')
+        self.assertEqual([[echo.path, 'woo'], [echo.path, 'yay'], [false.path], [python3.path, '-c', "print('x' * 1000, end = '')"], [echo.path, 'a\nb'], [python3.path, '-c', 'bytearray(50 << 20)']], [t.cmd for t in traces])
+        self.assertEqual([0, 0, 1, 0, 0, 0], [t.returncode for t in traces])
+        self.assertEqual([4, None, 0, 1000, None, 0], [t.captured for t in traces])
+        for t in traces:
+            self.assertGreater(t.wall, 0)
+            self.assertIsNot(None, t.utime)
+            self.assertIsNot(None, t.stime)
+        self.assertGreater(traces[-1].maxrss, 50 << 10)
+        stats = aggregator.programs[echo.path]
+        self.assertEqual(3, stats.count)
+        self.assertEqual(0, stats.failures)
+        self.assertEqual(3, sum(stats.histogram.values()))
+        self.assertEqual(1, aggregator.programs[false.path].failures)
+
+    def test_tracingbackends(self):
+        from lagoon import echo
+        from lagoon.builtins import builtinpopen
+        traces = []
+        with tracing(traces.append):
+            self.assertEqual('fs\n', echo[forkserver]('fs'))
+            self.assertEqual('builtin\n', echo[partial](popen = builtinpopen)('builtin'))
+            self.assertEqual('spawn\n', echo[spawn]('spawn'))
+        self.assertEqual([[echo.path, 'fs'], [echo.path, 'builtin'], [echo.path, 'spawn']], [t.cmd for t in traces])
+        self.assertEqual([0, 0, 0], [t.returncode for t in traces])
+        self.assertEqual([3, 8, 6], [t.captured for t in traces])
+        for t in traces:
+            self.assertGreater(t.wall, 0)
+        self.assertEqual([True, True, False], [t.rusage is None for t in traces])
+
+    def test_memo(self):
+        from lagoon import date, python3
+        from lagoon.util import ALWAYS
+        for m in memo(5), memo(5, maxsize = 1), memo(.1), memo(5, cache = ALWAYS):
+            m.clear()
+        ns = date[memo(5)][partial]('+%N')
+        t = ns()
+        self.assertEqual(t, ns())
+        self.assertEqual(t, date[memo(5)]('+%N'))
+        self.assertNotEqual(t, date('+%N'))
+        self.assertNotEqual(t, ns(cwd = '/'))
+        self.assertNotEqual(t, ns(env = dict(TestLagoon = 'x')))
+        self.assertNotEqual(t, ns[print, bool]())
+        self.assertNotEqual(t, ns(pass_fds = [])) # Unhashable so not memoised.
+        lru = date[memo(5, maxsize = 1)]
+        t1 = lru('+%N')
+        self.assertEqual(t1, lru('+%N'))
+        lru('+%s%N')
+        self.assertNotEqual(t1, lru('+%N'))
+        short = date[memo(.1)]
+        t = short('+%N')
+        self.assertEqual(t, short('+%N'))
+        time.sleep(.15)
+        self.assertNotEqual(t, short('+%N'))
+        script = python3._c[partial]('import sys, time; print(time.time_ns(), file = sys.stderr); sys.exit(1)', stderr = subprocess.PIPE)
+        def stderr(program):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                program()
+            return cm.exception.stderr
+        self.assertNotEqual(stderr(script[memo(5)]), stderr(script[memo(5)]))
+        self.assertEqual(stderr(script[memo(5, cache = ALWAYS)]), stderr(script[memo(5, cache = ALWAYS)]))
+
+    def test_memomodes(self):
+        from lagoon import date
+        for k, l in [lines, memo(5)], [memo(5), lines], [aio, memo(5)], [memo(5), aio], [tee(StringIO()), memo(5)], [memo(5), xargs()]:
+            with self.assertRaises(ValueError):
+                date[k, l]
+        with self.assertRaises(ValueError), date[memo(5)][bg]():
+            pass
+
+    def test_ndjson(self):
+        from lagoon import false, python3
+        script = python3._c
+        self.assertEqual([{'a': 1}, [2], 'x'], list(script[ndjson]('''print('{"a": 1}')\nprint()\nprint('\\x1e[2]')\nprint('"x"', end = '')''')))
+        g = script[ndjson]('import time\nprint(1, flush = True)\ntime.sleep(5)\nprint(2)')
+        self.assertEqual(1, next(g))
+        g.close() # Kills the child.
+        with self.assertRaises(ValueError) as cm:
+            list(script[ndjson]("print('[1]')\nprint('[2')"))
+        self.assertTrue(str(cm.exception).startswith('Malformed line 2 at byte 4: '))
+        with self.assertRaises(ValueError) as cm:
+            list(script[ndjson(maxline = 4)]("print('[1]')\nprint('[22]')"))
+        self.assertEqual('Line 2 at byte 4 is longer than 4 bytes.', str(cm.exception))
+        with self.assertRaises(subprocess.CalledProcessError):
+            list(script[ndjson]('print(1)\nraise SystemExit(1)'))
+        self.assertEqual([], list(false[ndjson](check = False)))
+
+    def test_tofile(self):
+        from lagoon import false, python3
+        with TemporaryDirectory() as d:
+            path = Path(d, 'out')
+            self.assertEqual(path, python3._c[tofile(path)]("print('woo')"))
+            self.assertEqual('woo\n', path.read_text())
+            with self.assertRaises(subprocess.CalledProcessError):
+                python3._c[tofile(path)]("print('yay')\nraise SystemExit(1)")
+            self.assertEqual('woo\n', path.read_text())
+            self.assertEqual(1, false[tofile(path)](check = False).returncode)
+            self.assertEqual('', path.read_text())
+            self.assertEqual(['out'], os.listdir(d)) # No temp files left behind.
+
+    def test_mmap(self):
+        from lagoon import python3, true
+        view = python3._c[mmap]('import sys\nsys.stdout.buffer.write(bytes(range(256)) * 4096)')
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(1 << 20, len(view))
+        self.assertEqual(b'\0\1\2', view[256:259])
+        self.assertEqual(b'', true[mmap]())
+        with self.assertRaises(ValueError):
+            true[print, mmap]()
+
+    def test_coprocess(self):
+        from lagoon import bash, cat, python3
+        with cat[coprocess(delimited())]() as c:
+            self.assertEqual('woo', c('woo\n'))
+            self.assertEqual('yay', c('yay\n'))
+        with cat[coprocess(delimited(b'<>'))]() as c:
+            self.assertEqual('woo', c('woo<>'))
+            self.assertEqual('y<a>y', c('y<a>y<>'))
+        with bash[coprocess(sentinel(b'END\n'))]() as c:
+            self.assertEqual('a\nb\n', c('echo a; echo b; echo END\n'))
+            self.assertEqual('', c('echo END\n'))
+        server = python3._c[partial]('''import os, sys
+for line in sys.stdin.buffer:
+    if line.startswith(b'die'):
+        sys.exit(3)
+    reply = line.strip() + b' ' + str(os.getpid()).encode()
+    sys.stdout.buffer.write(len(reply).to_bytes(4, 'big') + reply)
+    sys.stdout.buffer.flush()''')
+        with server[coprocess(lengthprefixed())]() as c:
+            pid = c('woo\n').split()[1]
+            self.assertEqual(f"yay {pid}", c('yay\n'))
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                c('die\n')
+            self.assertEqual(3, cm.exception.returncode)
+            self.assertNotEqual(pid, c('woo\n').split()[1]) # Restarted.
+        with server[coprocess(lengthprefixed(), size = 3)]() as pool, ThreadPoolExecutor(10) as e:
+            replies = list(e.map(pool, [f"{i}\n" for i in range(100)]))
+        self.assertEqual([str(i) for i in range(100)], [r.split()[0] for r in replies])
+        self.assertLessEqual(len({r.split()[1] for r in replies}), 3)
+
+    def test_forkserver(self):
+        from lagoon import false, python3
+        script = python3[forkserver]._c
+        self.assertNotEqual(str(os.getpid()), script[ONELINE]('import os; print(os.getppid())'))
+        self.assertEqual(str(os.getpid()), script[ONELINE]('import os; print(os.getppid())', preexec_fn = lambda: None)) # Fallback.
+        self.assertEqual('/tmp y\n', script('import os; print(os.getcwd(), os.environ["TestLagoon"])', cwd = '/tmp', env = dict(TestLagoon = 'y')))
+        self.assertEqual('WOO\n', script('import sys; print(sys.stdin.read().upper())', input = 'woo'))
+        self.assertEqual(b'out\nerr\n', script('import sys; print("out", flush = True); print("err", file = sys.stderr)', stderr = subprocess.STDOUT, universal_newlines = False))
+        self.assertEqual(1, false[forkserver](check = False).returncode)
+        with self.assertRaises(FileNotFoundError):
+            Program.text('/nonexistent')[forkserver]()
+        with script[bg]('import time; time.sleep(10)', check = False) as process:
+            self.assertIs(None, process.poll())
+            process.terminate()
+        self.assertEqual(-SIGTERM, process.returncode)
+        process.kill() # The helper has reaped it, so must not be signalled again.
+        self.assertEqual(-SIGTERM, process.returncode)
+        with script[bg]('import sys; sys.stdin.read()', stdin = subprocess.PIPE, check = False) as process:
+            process.stdin.close()
+        process.send_signal(SIGKILL)
+        self.assertEqual(0, process.returncode)
+        traces = []
+        with tracing(traces.append):
+            script('pass')
+        self.assertEqual(0, traces[0].returncode)
+
+    def test_forkserverenv(self):
+        from lagoon.forkserver import _helperenv
+        with patch.dict(os.environ, PYTHONPATH = '/woo'):
+            self.assertEqual(os.pathsep.join([PYTHONPATH, '/woo']), _helperenv()['PYTHONPATH'])
+        with patch.dict(os.environ):
+            os.environ.pop('PYTHONPATH', None)
+            self.assertEqual(PYTHONPATH, _helperenv()['PYTHONPATH'])
+
+    def test_processgroup(self):
+        from lagoon import python3, true
+        script = python3._c
+        chunks = {}
+        with ProcessGroup() as group:
+            members = [group.add(script, f"import sys\nfor _ in range(1000): print({i}, file = sys.stdout if {i} % 2 else sys.stderr)", stderr = subprocess.PIPE, onstdout = chunks.setdefault(i, []).append, onstderr = chunks[i].append) for i in range(50)]
+            member = group.add(true, stdout = None)
+            group.run()
+        for i in range(50):
+            self.assertEqual(f"{i}\n" * 1000, ''.join(chunks[i]))
+            self.assertEqual(0, members[i].process.returncode)
+        self.assertEqual(0, member.process.returncode)
+        with ProcessGroup() as group:
+            ok = group.add(Program.binary(python3.path)._c, 'print(1)')
+            bad = group.add(script, 'raise SystemExit(3)', check = False)
+            events = list(group.events())
+        self.assertEqual(b'1\n', b''.join(v for m, n, v in events if m is ok and 'stdout' == n))
+        self.assertEqual((ok, 'returncode', 0), [e for e in events if e[0] is ok][-1])
+        self.assertEqual([(bad, 'returncode', 3)], [e for e in events if e[0] is bad])
+        with self.assertRaises(subprocess.CalledProcessError) as cm, ProcessGroup() as group:
+            slow = group.add(script, 'import time; time.sleep(10)')
+            group.add(script, 'raise SystemExit(3)')
+            group.run()
+        self.assertEqual(3, cm.exception.returncode)
+        self.assertEqual(-SIGKILL, slow.process.returncode)
+
+    def test_capture(self):
+        from lagoon import cat, python3
+        script = python3._c
+        code = '''import sys
+for i in range(100000):
+    print(f"{i:05}", file = sys.stdout if i % 2 else sys.stderr)'''
+        result = script[capture(limit = 30, head = 12)](code)
+        self.assertEqual('00001\n00003\n99995\n99997\n99999\n', result.stdout)
+        self.assertEqual('00000\n00002\n99994\n99996\n99998\n', result.stderr)
+        self.assertEqual(300000 - 30, result.stdoutdropped)
+        self.assertEqual(300000 - 30, result.stderrdropped)
+        self.assertEqual('woo\n', script[capture()]('print("woo")', stderr = subprocess.DEVNULL)) # Usual transform.
+        result = Program.binary(python3.path)._c[capture(limit = 4)]('print("woo")')
+        self.assertEqual((b'woo\n', b'', 0), (result.stdout, result.stderr, result.stdoutdropped))
+        self.assertEqual(3, script[capture(), partial](check = False)('raise SystemExit(3)').returncode)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            script[capture(limit = 2, head = 0)]('import sys; print("woo"); sys.exit("yay")')
+        self.assertEqual(('o\n', 'y\n'), (cm.exception.stdout, cm.exception.stderr))
+        self.assertEqual(b'hello', Program.binary(cat.path)[capture()](input = b'hello').stdout)
+        self.assertEqual('hello', cat[capture()](input = 'hello').stdout)
+        with self.assertRaises(ValueError):
+            cat[capture()](input = 'hello', stdin = subprocess.DEVNULL)
+
+    def test_xargs(self):
+        from lagoon import echo, python3
+        paths = [f"path{i}" for i in range(200000)]
+        with self.assertRaises(OSError):
+            echo(*paths) # E2BIG.
+        result = echo[xargs](*paths)
+        self.assertEqual(paths, result.split())
+        self.assertGreater(result.count('\n'), 1) # Multiple batches.
+        result = echo[xargs(workers = 4, maxargs = 7), partial](check = False)(*range(100))
+        self.assertEqual([list(map(str, range(i, min(i + 7, 100)))) for i in range(0, 100, 7)], [l.split() for l in result.stdout.splitlines()])
+        self.assertEqual(15, len(result.batches))
+        self.assertEqual('', echo[xargs]())
+        script = python3._c[partial]('import sys; print(*sys.argv[1:]); sys.exit(any(a.startswith("bad") for a in sys.argv[1:]))')
+        self.assertFalse(script[xargs(maxargs = 2), bool](*'abcd', 'bad', 'e', stdout = subprocess.DEVNULL))
+        self.assertTrue(script[xargs(maxargs = 2), bool](*'abcd', stdout = subprocess.DEVNULL))
+        with self.assertRaises(BatchError) as cm:
+            script[xargs(maxargs = 2)](*'abcd', 'bad', 'e')
+        self.assertEqual('a b\nc d\nbad e\n', cm.exception.stdout)
+        self.assertEqual([[script.path, '-c', script.args[1], 'bad', 'e']], [b.args for b in cm.exception.failures()])
+
+    def test_cassette(self):
+        from lagoon import date, echo, false, python3
+        from lagoon.cassette import Cassette, UnmatchedInvocation
+        script = python3._c
+        def session():
+            return [
+                date('+%N'),
+                date('+%N'),
+                echo[json]('[1, 2]'),
+                false[print, bool](),
+                echo[NOEOL]('woo'),
+                script('import sys; sys.stdout.write(sys.stdin.read().upper())', input = 'yay'),
+                script('import os, sys; print(os.getcwd(), os.environ["TestLagoon"]); sys.stderr.buffer.write(bytes([0xff]))', cwd = '/tmp', env = dict(TestLagoon = 'x'), stderr = subprocess.PIPE, universal_newlines = False),
+                list(echo[lines]('a\nb')),
+                echo[tee(lambda _: None)]('tee'),
+                script[capture()]('import sys; print("out"); print("err", file = sys.stderr)'),
+                script('import sys; print("1"); sys.stdout.flush(); print("2", file = sys.stderr)', stderr = subprocess.STDOUT),
+                script[partial](check = False)('raise SystemExit(3)').returncode,
+                (echo.piped | script[partial]('import sys; print(sys.stdin.read().upper())'))(),
+        ]
+        def plain(result):
+            return (result.returncode, result.stdout, result.stderr) if isinstance(result, subprocess.CompletedProcess) else result
+        with TemporaryDirectory() as d:
+            path = Path(d, 'cassette')
+            with Cassette(path).record():
+                with echo[bg]('bg') as stdout:
+                    recorded = [stdout.read(), *map(plain, session())]
+            self.assertNotEqual(recorded[1], recorded[2])
+            self.assertEqual((0, b'/tmp x\n', b'\xff'), recorded[7])
+            with Cassette(path).replay(), patch('subprocess._fork_exec', side_effect = AssertionError), patch('os.posix_spawn', side_effect = AssertionError):
+                with echo[bg]('bg') as stdout:
+                    replayed = [stdout.read(), *map(plain, session())]
+                self.assertEqual(recorded[2], date('+%N')) # Last one repeats.
+                with self.assertRaises(UnmatchedInvocation) as cm:
+                    echo('nosuch')
+                self.assertIn("'nosuch'", str(cm.exception))
+                with self.assertRaises(UnmatchedInvocation) as cm:
+                    echo('bg', cwd = '/')
+                self.assertIn('same argv', str(cm.exception))
+            self.assertEqual(recorded, replayed)
+
+    def test_cassetteinteractive(self):
+        from lagoon import cat, yes
+        from lagoon.cassette import Cassette
+        with TemporaryDirectory() as d, Cassette(Path(d, 'cassette')).record():
+            chunks = yes[lines]()
+            self.assertEqual('y\n', next(chunks))
+            chunks.close() # Kills the real process.
+            with cat[bg](stdin = subprocess.PIPE) as process:
+                for line in 'woo\n', 'yay\n':
+                    process.stdin.write(line)
+                    process.stdin.flush()
+                    self.assertEqual(line, process.stdout.readline())
+                process.stdin.close()
+            with self.assertRaises(subprocess.CalledProcessError) as cm, yes[bg](stdout = subprocess.DEVNULL, aux = 'terminate') as terminate:
+                terminate()
+            self.assertEqual(-SIGTERM, cm.exception.returncode)
+
+    def test_iterablestdin(self):
+        from lagoon import cat, head, python3
+        self.assertEqual(''.join(f"{i}\n" for i in range(100000)), cat(stdin = (f"{i}\n" for i in range(100000))))
+        self.assertEqual(b'ab', Program.binary(cat.path)(stdin = [b'a', 'b']))
+        with cat[bg](stdin = iter(['woo\n', 'yay\n'])) as stdout:
+            self.assertEqual('woo\nyay\n', stdout.read())
+        closed = []
+        def forever():
+            try:
+                while True:
+                    yield 'x\n'
+            finally:
+                closed.append(True)
+        self.assertEqual('x\n', head._1(stdin = forever()))
+        for _ in range(100):
+            if closed:
+                break
+            time.sleep(.01)
+        self.assertEqual([True], closed)
+        produced = []
+        def slow():
+            for i in range(3):
+                produced.append(i)
+                yield f"{i}\n"
+                time.sleep(.05)
+        self.assertEqual([['0\n', [0]], ['1\n', [0, 1]], ['2\n', [0, 1, 2]]], [[l, produced.copy()] for l in python3[lines]('-u', '-c', 'import sys\nfor l in sys.stdin: print(l, end = "")', stdin = slow())]) # Concurrent.
+        def broken():
+            yield 'woo\n'
+            raise Exception('boom')
+        with self.assertLogs('lagoon.program') as cm, self.assertRaises(subprocess.CalledProcessError) as e:
+            python3('-c', 'import time; time.sleep(5)', stdin = broken())
+        self.assertEqual(-SIGKILL, e.exception.returncode)
+        self.assertIn('boom', cm.output[0])
+        async def main():
+            with self.assertRaises(ValueError):
+                await cat[aio](stdin = ['abc\n'])
+            with self.assertRaises(ValueError):
+                async with cat[bg](stdin = ['abc\n']):
+                    pass
+        asyncio.run(asyncio.wait_for(main(), 5))
+
+    def test_transfer(self):
+        from lagoon import cat
+        data = os.urandom(1 << 20)
+        with TemporaryFile() as src, TemporaryFile() as dst:
+            src.write(data)
+            src.seek(0)
+            with Program.binary(cat.path)[bg](stdin = subprocess.PIPE) as process:
+                def feed():
+                    with process.stdin:
+                        transfer(src, process.stdin)
+                t = Thread(target = feed)
+                t.start()
+                self.assertEqual(len(data), transfer(process.stdout, dst))
+                t.join()
+            dst.seek(0)
+            self.assertEqual(data, dst.read())